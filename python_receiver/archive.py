@@ -0,0 +1,250 @@
+'''
+    Always-on archive of the raw int16 stream, in fixed-size memory-mapped segment files.
+
+    Every segment "audio-<start ms>.raw" holds <segment_seconds> of samples and has a small "audio-<start ms>.idx"
+    next to it: 16 bytes records (float64 wall clock time, int64 sample offset) written at every flush and at every
+    gap in the stream, so a time maps to an offset by interpolating from the last record before it. The last record
+    also marks how much of the segment is valid after a restart or a power cut.
+
+    Appending a block is a memcpy in the page cache, the data reach the SD card only at flush() (every
+    <flush_interval> seconds) or when the kernel decides, in big sequential writes. The files are created sparse,
+    so preallocating them costs nothing. The msync of the flushes and the deletions of the retention run on a
+    background thread: append() is called from the receiver loop, and a slow SD card must not stall it.
+'''
+
+import glob
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+
+INDEX_RECORD = np.dtype([("time", "<f8"), ("offset", "<i8")])
+
+
+class Segment:
+
+    def __init__(self, path, samples, mode):
+        self.path = path
+        self.index_path = path[:-len(".raw")] + ".idx"
+        self.start = int(os.path.basename(path)[len("audio-"):-len(".raw")]) / 1000.0
+        self.data = np.memmap(path, np.int16, mode, shape=(samples,))
+        self.index = np.fromfile(self.index_path, INDEX_RECORD) if os.path.exists(self.index_path) else np.zeros(0, INDEX_RECORD)
+        self.pending = []       # Index records not written yet
+
+    @property
+    def length(self):
+        # Valid samples, up to the last index record
+        return int(self.index["offset"][-1]) if self.index.size else 0
+
+    @property
+    def end(self):
+        return float(self.index["time"][-1]) if self.index.size else self.start
+
+    def mark(self, t, offset):
+        record = np.array([(t, offset)], INDEX_RECORD)
+        self.index = np.concatenate((self.index, record))
+        self.pending.append(record)
+
+    def take_pending(self):
+        records, self.pending = self.pending, []
+        return records
+
+    def flush(self, data, records):
+        # On the flusher thread: <data> first (the writable map, even if the segment has been closed meanwhile),
+        # then the index <records> saying it is valid
+        data.flush()
+        if records:
+            with open(self.index_path, "ab") as f:
+                for record in records:
+                    record.tofile(f)
+
+    def offset_at(self, t, valid):
+        # Sample offset of time <t>, clipped to the run it falls in and to the <valid> samples
+        if not self.index.size:
+            return 0
+        k = max(int(np.searchsorted(self.index["time"], t, side="right")) - 1, 0)
+        anchor_t, anchor_offset = float(self.index["time"][k]), int(self.index["offset"][k])
+        limit = int(self.index["offset"][k + 1]) if k + 1 < self.index.size else valid
+        return min(max(anchor_offset + int(round((t - anchor_t) * self.fsamp)), anchor_offset), limit, valid)
+
+    def size(self):
+        return os.path.getsize(self.path) + (os.path.getsize(self.index_path) if os.path.exists(self.index_path) else 0)
+
+    def remove(self):
+        # Views already handed out by query() stay valid, Linux frees the file when they are gone
+        for path in (self.path, self.index_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class AudioArchive:
+
+    def __init__(self, directory, fsamp=16000, segment_seconds=600, max_bytes=None, max_age=None,
+                 flush_interval=30.0, gap_tolerance=0.25):
+        self.directory = directory
+        self.fsamp = fsamp
+        self.segment_samples = int(segment_seconds * fsamp)
+        self.max_bytes = max_bytes      # Retention, oldest segments are deleted past these, None for no limit
+        self.max_age = max_age          # [s]
+        self.flush_interval = flush_interval
+        self.gap_tolerance = gap_tolerance      # [s] of disagreement between the clock and the sample count that opens a new run
+        self._lock = threading.Lock()   # query() can be called from other threads
+        self._current = None
+        self._next_time = None          # Expected time of the next sample, from the sample count
+        self._last_flush = 0.0
+        self._jobs = queue.Queue()      # (segment, map, records) to flush, ("retain", time, closed segments), None to stop
+
+        # Counters
+        self.samples_written = 0
+        self.gaps = 0
+        self.flushes = 0
+        self.segments_removed = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._segments = [self._open(path, "r") for path in sorted(glob.glob(os.path.join(directory, "audio-*.raw")))]
+        self._segments = [s for s in self._segments if s is not None]
+        self._flusher = threading.Thread(target=self._flush_worker, name="archive-flusher")
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    def _open(self, path, mode):
+        try:
+            segment = Segment(path, self.segment_samples, mode)
+        except (OSError, ValueError) as e:
+            print("Archive segment " + path + " unreadable: " + str(e))
+            return None
+        segment.fsamp = self.fsamp
+        return segment
+
+    def append(self, samples, t=None):
+        # <samples> int16 block, <t> wall clock time of its last sample (the arrival time of the serial block)
+        t = time.time() if t is None else t
+        first = t - (samples.size - 1) / self.fsamp
+        with self._lock:
+            # The sample count is the clock, blocks read in a burst after a stall are not early. Only a block later
+            # than the count (restart, lost data, clock step forward) opens a new run.
+            if self._next_time is None or first - self._next_time > self.gap_tolerance:
+                if self._current is not None and self._written < self.segment_samples:
+                    self.gaps += 1
+                    self._current.mark(first, self._written)
+                self._next_time = first
+            position = 0
+            while position < samples.size:
+                if self._current is None or self._written >= self.segment_samples:
+                    self._roll(first + position / self.fsamp)
+                segment = self._current
+                n = min(samples.size - position, self.segment_samples - self._written)
+                segment.data[self._written:self._written + n] = samples[position:position + n]
+                self._written += n
+                position += n
+            self.samples_written += samples.size
+            self._next_time += samples.size / self.fsamp
+
+            if t - self._last_flush >= self.flush_interval:
+                # Back on the wall clock (slow drift of the microphone clock), never before the last record
+                self._next_time = max(t + 1 / self.fsamp, float(self._current.index["time"][-1]))
+                self._flush(self._next_time)
+                self._last_flush = t
+
+    def _roll(self, t):
+        # Close the full segment and open a new one starting at <t>
+        if self._current is not None:
+            self._flush(t)
+            self._current.data = np.memmap(self._current.path, np.int16, "r", shape=(self.segment_samples,))
+        path = os.path.join(self.directory, "audio-{0:013d}.raw".format(int(t * 1000)))
+        segment = self._open(path, "w+")
+        segment.mark(t, 0)
+        self._segments.append(segment)
+        self._current = segment
+        self._written = 0
+        # Only the segments closed by now, their last flush is queued before this job
+        self._jobs.put(("retain", t, [s for s in self._segments if s is not segment]))
+
+    def _flush(self, next_time):
+        # Record where the stream is, the flusher pushes the dirty pages to the card. Called with the lock held
+        segment = self._current
+        if segment is None:
+            return
+        if segment.index["offset"][-1] != self._written:
+            segment.mark(next_time, self._written)
+        self._jobs.put((segment, segment.data, segment.take_pending()))
+
+    def _flush_worker(self):
+        while True:
+            job = self._jobs.get()
+            try:
+                if job is None:
+                    return
+                if job[0] == "retain":
+                    self._retain(job[1], job[2])
+                else:
+                    segment, data, records = job
+                    segment.flush(data, records)
+                    with self._lock:
+                        self.flushes += 1
+            except OSError as e:
+                print("Archive flush failed: " + str(e))
+            finally:
+                self._jobs.task_done()
+
+    def _retain(self, now, closed):
+        # Delete the oldest <closed> segments past the size or the age limit, on the flusher thread
+        with self._lock:
+            segments = list(self._segments)
+            closed = [s for s in closed if s in segments]
+        total = sum(s.size() for s in segments) if self.max_bytes is not None else 0
+        for segment in closed:
+            too_big = self.max_bytes is not None and total > self.max_bytes
+            too_old = self.max_age is not None and now - segment.end > self.max_age
+            if not too_big and not too_old:
+                break
+            total -= segment.size()
+            with self._lock:
+                self._segments.remove(segment)      # query() doesn't see it anymore
+                self.segments_removed += 1
+            segment.remove()
+
+    def flush(self, wait=False):
+        # Non-blocking for the receiver loop, <wait> for the data to be on the card
+        with self._lock:
+            self._flush(self._next_time if self._next_time is not None else time.time())
+        if wait:
+            self._jobs.join()
+
+    def close(self):
+        self.flush(wait=True)
+        with self._lock:
+            self._current = None
+            self._next_time = None
+        self._jobs.put(None)
+        self._flusher.join()
+
+    def query(self, start, end):
+        # Samples between the wall clock times <start> and <end>, a view on the memory map when the range is in
+        # one segment (zero-copy), a copy when it crosses segments. Holes in the stream are skipped, not zero-filled.
+        with self._lock:
+            parts = []
+            for segment in self._segments:
+                current = segment is self._current
+                if (self._next_time if current else segment.end) < start or segment.start > end:
+                    continue
+                valid = self._written if current else segment.length
+                a = segment.offset_at(start, valid)
+                b = segment.offset_at(end, valid)
+                if b > a:
+                    parts.append(segment.data[a:b])
+        if not parts:
+            return np.zeros(0, np.int16)
+        if len(parts) == 1:
+            return parts[0]
+        return np.concatenate(parts)
+
+    def stats(self):
+        with self._lock:
+            return {"archive_segments": len(self._segments), "archive_samples_written": self.samples_written,
+                    "archive_gaps": self.gaps, "archive_flushes": self.flushes, "archive_segments_removed": self.segments_removed}
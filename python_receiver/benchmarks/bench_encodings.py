@@ -0,0 +1,71 @@
+'''
+    Compare the upload encodings of Recognizer.recognize_wit(): payload bytes, encode time and end-to-end latency
+    against the local stand-in server, on a slow emulated uplink.
+
+    python benchmarks/bench_encodings.py --bandwidth 64000 --clip microphone-results.wav
+'''
+
+import argparse
+import os
+import statistics
+import sys
+import time
+import wave
+
+import numpy as np
+import speech_recognition as sr
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_wit import FakeWitServer
+
+
+def load_clip(path, seconds):
+    # WAV files or raw little-endian int16 samples at 16 kHz (like test_golang/raw_wav.bin)
+    if path.endswith(".wav"):
+        with wave.open(path, "rb") as w:
+            rate = w.getframerate()
+            samples = np.frombuffer(w.readframes(w.getnframes()), np.int16)
+    else:
+        rate = 16000
+        samples = np.fromfile(path, np.int16)
+    return samples[:int(seconds * rate)], rate
+
+
+def main(args):
+    samples, rate = load_clip(args.clip, args.seconds)
+    audio = sr.AudioData(samples.tobytes(), rate, 2)
+
+    server = FakeWitServer(latency=args.latency, bandwidth=args.bandwidth).start()
+    r = sr.Recognizer()
+    r.wit_api_url = server.url
+
+    print("{0:>6} {1:>6} {2:>9} {3:>11} {4:>13} {5:>13}".format("codec", "rate", "bytes", "encode ms", "latency p50", "latency max"))
+    for encoding in ("wav", "raw", "mulaw", "flac"):
+        for convert_rate in (None, 8000):
+            encode = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                payload, _ = sr.encode_audio(audio, encoding, convert_rate)
+                encode.append(time.perf_counter() - start)
+
+            latency = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                r.recognize_wit(audio, key="benchmark", encoding=encoding, convert_rate=convert_rate)
+                latency.append(time.perf_counter() - start)
+
+            print("{0:>6} {1:>6} {2:>9} {3:>11.2f} {4:>12.3f}s {5:>12.3f}s".format(
+                encoding, convert_rate or rate, len(payload), 1000 * statistics.median(encode),
+                statistics.median(latency), max(latency)))
+
+    server.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the Wit.ai upload encodings")
+    parser.add_argument("--clip", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "microphone-results.wav"))
+    parser.add_argument("--seconds", type=float, default=2.5, help="length of the clip, like an utterance of the receiver")
+    parser.add_argument("--bandwidth", type=float, default=64000, help="emulated uplink in bytes per second")
+    parser.add_argument("--latency", type=float, default=0.2, help="server processing time in seconds")
+    parser.add_argument("--repeat", type=int, default=5)
+    main(parser.parse_args())
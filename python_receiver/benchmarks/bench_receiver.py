@@ -0,0 +1,166 @@
+'''
+    End-to-end benchmark of recognizer.py: a recording is played on a pty at 16 kHz (or faster), the receiver runs
+    unmodified in a child process against local stand-ins of Wit.ai (fake_wit.py) and of the MQTT broker
+    (fake_mqtt.py), and at the end it reports:
+
+    - CPU time per second of audio (user + system, all threads and worker processes), the number to compare with the Go receiver
+    - trigger to publish latency percentiles
+    - peak RSS
+    - blocks sent on the pty but never processed, serial gaps, losses and overruns, utterances dropped by the queue
+
+    python benchmarks/bench_receiver.py --clip microphone-results.wav --speeds 1 4 --latency 0.3
+'''
+
+import argparse
+import json
+import os
+import resource
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+RECEIVER = os.path.dirname(HERE)
+sys.path.insert(0, HERE)
+sys.path.insert(0, RECEIVER)
+
+
+def child(config):
+    # Runs inside the child process: the receiver with its settings overridden, then one JSON line of results
+    import recognizer as R
+
+    for name, value in config.items():
+        setattr(R, name, value)
+
+    raw = {"trigger_to_publish": [], "capture": [], "recognition": [], "block_processing": []}
+    observe = R.metrics.observe
+
+    def recording_observe(name, seconds):
+        # Exact percentiles, the histograms of metrics.py only interpolate inside the buckets
+        if name in raw:
+            raw[name].append(seconds)
+        observe(name, seconds)
+
+    R.metrics.observe = recording_observe
+    start = resource.getrusage(resource.RUSAGE_SELF)
+    R.main()
+    end = resource.getrusage(resource.RUSAGE_SELF)
+    workers = resource.getrusage(resource.RUSAGE_CHILDREN)     # Recognition processes, reaped by main()
+
+    result = {"cpu": end.ru_utime - start.ru_utime + end.ru_stime - start.ru_stime + workers.ru_utime + workers.ru_stime,
+              "peak_rss_kb": end.ru_maxrss, "raw": raw, "stream": R.device_list[0].accounting.stats(), "queue": R.audio_queue.stats()}
+    print("BENCH " + json.dumps(result), flush=True)
+
+
+def run(args, speed):
+    from fake_mqtt import FakeBroker
+    from fake_wit import FakeWitServer
+    from replay import feed_pty, load_samples
+
+    samples = load_samples(args.clip)
+    audio_seconds = samples.size / 16000
+    wit = FakeWitServer(latency=args.latency).start()
+    broker = FakeBroker().start()
+    start = threading.Event()
+    drain = args.deadline + 2
+    # Silence after the recording, like a real microphone in a quiet room: the receiver must not time out and
+    # reconnect while the last recognitions complete
+    name, feeder = feed_pty(args.clip, speed=speed, start=start, linger=drain + 60, silence=True)
+
+    # The pauses and the admission control run on the wall clock, scaled with the replay rate
+    config = {"source": name, "serial_pause": 0.032 / speed, "admission_rate": 6.0 * speed, "admission_cooldown": 60.0 / speed, "wit_api_url": wit.url, "mqtt_broker": "127.0.0.1",
+              "mqtt_port": broker.port, "metrics_port": None, "async_recognition": args.async_recognition,
+              "recognition_workers": args.workers, "recognition_processes": args.processes, "deadline_budget": args.deadline}
+    process = subprocess.Popen([sys.executable, "-u", os.path.abspath(__file__), "--child", json.dumps(config)],
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, cwd=RECEIVER)
+
+    result = {}
+    log = []
+
+    def reader():
+        for line in process.stdout:
+            if line.startswith("BENCH "):
+                result.update(json.loads(line[len("BENCH "):]))
+            else:
+                log.append(line.rstrip())
+                if name in line:
+                    start.set()     # The receiver opened the pty, start playing
+
+    thread = threading.Thread(target=reader)
+    thread.daemon = True
+    thread.start()
+
+    if not start.wait(30):
+        process.kill()
+        raise RuntimeError("The receiver didn't open " + name + ":\n" + "\n".join(log[-20:]))
+    time.sleep(audio_seconds / speed + drain)       # Play, then let the last recognitions complete
+    feeder.stop.set()
+    time.sleep(0.5)         # The receiver empties the pty, well before its 2 s read timeout
+    process.send_signal(signal.SIGTERM)
+    try:
+        process.wait(60)
+    except subprocess.TimeoutExpired:
+        process.kill()
+    thread.join(5)
+    wit.stop()
+    broker.stop()
+    if not result:
+        raise RuntimeError("No result from the receiver:\n" + "\n".join(log[-20:]))
+
+    published = [m for m in broker.messages if m[1].endswith("/command/switch:0")]
+    sent_blocks = feeder.sent // 1024
+    processed_blocks = result["stream"]["stream_samples"] // 512
+    return {"speed": speed, "audio_seconds": processed_blocks * 512 / 16000, "cpu": result["cpu"], "peak_rss_kb": result["peak_rss_kb"],
+            "raw": result["raw"], "stream": result["stream"], "queue": result["queue"], "published": len(published),
+            "wit_requests": wit.requests, "dropped_blocks": max(sent_blocks - processed_blocks, 0)}
+
+
+def percentiles(values):
+    if not values:
+        return "n=0"
+    p = np.percentile(values, [50, 95, 99]) * 1000
+    return "n={0} p50={1:.1f} p95={2:.1f} p99={3:.1f} ms".format(len(values), *p)
+
+
+def report(r):
+    print("speed x{0:g}: {1:.1f} s of audio".format(r["speed"], r["audio_seconds"]))
+    print("  CPU {0:.3f} s per audio second ({1:.2f}% of a core at real time), peak RSS {2:.1f} MB".format(
+          r["cpu"] / r["audio_seconds"], 100 * r["cpu"] / r["audio_seconds"], r["peak_rss_kb"] / 1024))
+    print("  trigger to publish " + percentiles(r["raw"]["trigger_to_publish"]))
+    print("  block processing   " + percentiles(r["raw"]["block_processing"]))
+    print("  recognition        " + percentiles(r["raw"]["recognition"]))
+    s, q = r["stream"], r["queue"]
+    print("  dropped blocks {0}, serial gaps {1}, losses {2} ({3} samples), overruns {4}".format(
+          r["dropped_blocks"], s["stream_gaps"], s["stream_losses"], s["stream_lost_samples"], s["stream_overruns"]))
+    print("  utterances {0} queued, {1} dropped, {2} Wit.ai requests, {3} commands published".format(
+          q["enqueued"], q["dropped_oldest"] + q["dropped_newest"], r["wit_requests"], r["published"]))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "--child":
+        child(json.loads(sys.argv[2]))
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of the Python receiver over a pty")
+    parser.add_argument("--clip", default=os.path.join(RECEIVER, "microphone-results.wav"), help="WAV or raw int16 recording at 16 kHz")
+    parser.add_argument("--speeds", type=float, nargs="+", default=[1.0, 4.0], help="replay rates, 1 is real time")
+    parser.add_argument("--latency", type=float, default=0.3, help="seconds of the fake Wit.ai answer")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--processes", type=int, default=0, help="recognize in worker processes, clips in shared memory")
+    parser.add_argument("--deadline", type=float, default=4.0)
+    parser.add_argument("--async-recognition", action="store_true", help="recognize in the event loop instead of threads")
+    parser.add_argument("--json", default=None, help="also save the raw results in this file")
+    args = parser.parse_args()
+
+    results = []
+    for speed in args.speeds:
+        r = run(args, speed)
+        report(r)
+        results.append(r)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f)
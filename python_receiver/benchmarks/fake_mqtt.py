@@ -0,0 +1,158 @@
+'''
+    Minimal MQTT 3.1.1 broker stand-in, enough for paho and the receiver: CONNECT, SUBSCRIBE, PUBLISH (QoS 0/1/2
+    handshakes), PINGREQ and DISCONNECT. Messages are forwarded to the subscribers at QoS 0 and logged with their
+    arrival time, and a command on "<id>/command/switch:0" is answered on "<id>/status/switch:0" like a Shelly.
+
+    Run it alone with "python fake_mqtt.py --port 1883", or use FakeBroker from a benchmark.
+'''
+
+import argparse
+import json
+import socketserver
+import struct
+import threading
+import time
+
+
+def topic_matches(pattern, topic):
+    p, t = pattern.split("/"), topic.split("/")
+    for k, level in enumerate(p):
+        if level == "#":
+            return True
+        if k >= len(t) or (level != "+" and level != t[k]):
+            return False
+    return len(p) == len(t)
+
+
+def encode_length(n):
+    out = bytearray()
+    while True:
+        byte = n % 128
+        n //= 128
+        out.append(byte | 0x80 if n else byte)
+        if not n:
+            return bytes(out)
+
+
+def publish_packet(topic, payload):
+    body = struct.pack("!H", len(topic)) + topic.encode() + payload
+    return b"\x30" + encode_length(len(body)) + body
+
+
+class FakeBroker(socketserver.ThreadingTCPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0, shelly=True):
+        super().__init__(("127.0.0.1", port), BrokerHandler)
+        self.shelly = shelly        # Echo the switch status like the real device
+        self.lock = threading.Lock()
+        self.subscriptions = []     # (pattern, handler)
+        self.messages = []          # (time.monotonic(), topic, payload, qos)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def route(self, topic, payload, qos):
+        with self.lock:
+            self.messages.append((time.monotonic(), topic, payload, qos))
+            targets = [h for pattern, h in self.subscriptions if topic_matches(pattern, topic)]
+        for handler in targets:
+            handler.send(publish_packet(topic, payload))
+        if self.shelly and topic.endswith("/command/switch:0"):
+            status = json.dumps({"id": 0, "output": payload == b"on"}).encode()
+            self.route(topic[:-len("/command/switch:0")] + "/status/switch:0", status, 0)
+
+
+class BrokerHandler(socketserver.BaseRequestHandler):
+
+    def setup(self):
+        self.write_lock = threading.Lock()
+
+    def send(self, data):
+        with self.write_lock:
+            try:
+                self.request.sendall(data)
+            except OSError:
+                pass
+
+    def read(self, n):
+        data = b""
+        while len(data) < n:
+            chunk = self.request.recv(n - len(data))
+            if not chunk:
+                raise ConnectionError("client gone")
+            data += chunk
+        return data
+
+    def handle(self):
+        server = self.server
+        try:
+            while True:
+                header = self.read(1)[0]
+                length, shift = 0, 0
+                while True:
+                    byte = self.read(1)[0]
+                    length += (byte & 0x7F) << shift
+                    shift += 7
+                    if not byte & 0x80:
+                        break
+                body = self.read(length) if length else b""
+                kind = header >> 4
+
+                if kind == 1:       # CONNECT
+                    self.send(b"\x20\x02\x00\x00")
+                elif kind == 3:     # PUBLISH
+                    qos = (header >> 1) & 3
+                    size = struct.unpack("!H", body[:2])[0]
+                    topic = body[2:2 + size].decode()
+                    rest = body[2 + size:]
+                    if qos:
+                        mid, rest = rest[:2], rest[2:]
+                        self.send((b"\x40\x02" if qos == 1 else b"\x50\x02") + mid)     # PUBACK or PUBREC
+                    server.route(topic, rest, qos)
+                elif kind == 6:     # PUBREL
+                    self.send(b"\x70\x02" + body[:2])      # PUBCOMP
+                elif kind == 8:     # SUBSCRIBE
+                    mid, rest, granted = body[:2], body[2:], b""
+                    while rest:
+                        size = struct.unpack("!H", rest[:2])[0]
+                        with server.lock:
+                            server.subscriptions.append((rest[2:2 + size].decode(), self))
+                        rest = rest[3 + size:]
+                        granted += b"\x00"      # Everything is delivered at QoS 0
+                    self.send(b"\x90" + encode_length(2 + len(granted)) + mid + granted)
+                elif kind == 12:    # PINGREQ
+                    self.send(b"\xd0\x00")
+                elif kind == 14:    # DISCONNECT
+                    break
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            with server.lock:
+                server.subscriptions = [(p, h) for p, h in server.subscriptions if h is not self]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Minimal MQTT broker stand-in")
+    parser.add_argument("--port", type=int, default=1883)
+    args = parser.parse_args()
+
+    broker = FakeBroker(args.port)
+    print("Fake MQTT broker listening on 127.0.0.1:{0}".format(broker.port))
+    try:
+        broker.serve_forever()
+    except KeyboardInterrupt:
+        pass
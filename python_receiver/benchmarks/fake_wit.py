@@ -0,0 +1,130 @@
+'''
+    Local stand-in for the Wit.ai HTTP API, to benchmark and test the recognizers without the network.
+
+    POST /speech answers with a single JSON object, POST /dictation (and any other path) with the chunked stream
+    of JSON objects the new Wit.ai API produces. The upload is throttled to <bandwidth> bytes per second to
+    emulate a slow uplink, and the answer comes <latency> seconds after the last byte.
+
+    Run it alone with "python fake_wit.py --port 8081" and point Recognizer.wit_api_url to http://127.0.0.1:8081
+    A captured /dictation response can be replayed with "--stream capture.bin --chunk 100", cut in small chunks to
+    exercise the streaming decoder on arbitrary boundaries.
+'''
+
+import argparse
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeWitServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.3, bandwidth=None, transcript="accendi luce", stream=None):
+        super().__init__(("127.0.0.1", port), FakeWitHandler)
+        self.latency = latency          # [s] "recognition" time after the upload
+        self.bandwidth = bandwidth      # [bytes/s] of the emulated uplink, None for unlimited
+        self.transcript = transcript
+        self.stream = stream            # Raw chunks replayed on /dictation, None to build them from the transcript
+        self.requests = 0
+        self.bytes_received = 0
+        self.content_types = []
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{0}".format(self.server_address[1])
+
+    def handle_error(self, request, client_address):
+        # Clients giving up on a slow answer (deadlines, hedging) are expected, not errors
+        if not isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            super().handle_error(request, client_address)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeWitHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get("Content-Length", 0))
+        received = 0
+        start = time.monotonic()
+        while received < length:
+            chunk = self.rfile.read(min(8192, length - received))
+            if not chunk:
+                break
+            received += len(chunk)
+            if server.bandwidth:
+                # Throttle the upload, as if it was on the slow link
+                delay = start + received / server.bandwidth - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+        server.requests += 1
+        server.bytes_received += received
+        server.content_types.append(self.headers.get("Content-Type"))
+
+        time.sleep(server.latency)
+        if self.path.startswith("/speech"):
+            body = json.dumps({"text": server.transcript, "intents": [], "entities": {}}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        # Chunked stream of JSON objects, like https://api.wit.ai/dictation
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for chunk in server.stream or dictation_chunks(server.transcript):
+            self.wfile.write("{0:x}\r\n".format(len(chunk)).encode() + chunk + b"\r\n")
+            self.wfile.flush()
+        self.wfile.write(b"0\r\n\r\n")
+
+    def log_message(self, *args):
+        pass
+
+
+def dictation_chunks(transcript):
+    # Partial transcriptions word by word, then the final one, separated by "\r\n" as Wit.ai does
+    words = transcript.split()
+    objects = [{"text": " ".join(words[:k]), "type": "PARTIAL_TRANSCRIPTION"} for k in range(1, len(words) + 1)]
+    objects.append({"text": transcript, "type": "FINAL_TRANSCRIPTION", "is_final": True})
+    return [json.dumps(o, indent=2).encode() + b"\r\n" for o in objects]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the Wit.ai API")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.3, help="seconds between the end of the upload and the answer")
+    parser.add_argument("--bandwidth", type=float, default=None, help="uplink in bytes per second, unlimited if omitted")
+    parser.add_argument("--transcript", default="accendi luce")
+    parser.add_argument("--stream", default=None, help="file with a captured /dictation response body to replay")
+    parser.add_argument("--chunk", type=int, default=1024, help="size of the replayed chunks in bytes")
+    args = parser.parse_args()
+
+    stream = None
+    if args.stream is not None:
+        with open(args.stream, "rb") as f:
+            body = f.read()
+        stream = [body[k:k + args.chunk] for k in range(0, len(body), args.chunk)]
+    server = FakeWitServer(args.port, args.latency, args.bandwidth, args.transcript, stream)
+    print("Fake Wit.ai listening on " + server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,143 @@
+'''
+    Labelled utterance store, to build a local command model from what the microphone really hears.
+
+    Every clip is saved with its transcript, the dispatched command, the trigger level and the timestamps. Samples are
+    deduplicated by content hash (blake2b) and packed in "shard-NNNNN.npz" files of <shard_size> clips, a shard holds
+    one contiguous int16 array plus the offsets of the clips. "index.jsonl" has one line per clip pointing to its
+    shard, written only after the shard, so a crash can't leave the index pointing to missing data.
+
+    put() only copies the samples and queues them, hashing, compression and disk writes happen on a writer thread.
+'''
+
+import glob
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+
+class ClipStore:
+
+    def __init__(self, directory, shard_size=256, queue_size=64, flush_interval=300.0, compress=True):
+        self.directory = directory
+        self.shard_size = shard_size
+        self.flush_interval = flush_interval    # [s] a partial shard is written after this, so a quiet day isn't lost
+        self.compress = compress
+        self.index_path = os.path.join(directory, "index.jsonl")
+        self._queue = queue.Queue(queue_size)
+        self._pending = []          # (samples, record) of the shard being built
+        self._lock = threading.Lock()
+
+        # Counters
+        self.stored = 0
+        self.duplicates = 0
+        self.dropped = 0
+        self.shards = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._hashes = set()
+        for record in self.records():
+            self._hashes.add(record["hash"])
+        shards = sorted(glob.glob(os.path.join(directory, "shard-*.npz")))
+        self._next_shard = int(os.path.basename(shards[-1])[len("shard-"):-len(".npz")]) + 1 if shards else 0
+
+        self._thread = threading.Thread(target=self._writer)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, samples, **record):
+        # Never blocks the caller: the clip is copied (its buffer is going back to the pool) and dropped if the writer is behind
+        try:
+            self._queue.put_nowait((np.array(samples, np.int16), record))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def _writer(self):
+        last_write = time.monotonic()
+        while True:
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                item = None
+            if item is not None and item[0] is None:
+                self._write_shard()     # close()
+                self._queue.task_done()
+                break
+            if item is not None:
+                samples, record = item
+                digest = hashlib.blake2b(samples.tobytes(), digest_size=16).hexdigest()
+                if digest in self._hashes:
+                    self.duplicates += 1
+                else:
+                    self._hashes.add(digest)
+                    record["hash"] = digest
+                    self._pending.append((samples, record))
+                self._queue.task_done()
+            if len(self._pending) >= self.shard_size or (self._pending and time.monotonic() - last_write >= self.flush_interval):
+                self._write_shard()
+                last_write = time.monotonic()
+
+    def _write_shard(self):
+        if not self._pending:
+            return
+        name = "shard-{0:05d}.npz".format(self._next_shard)
+        lengths = np.array([s.size for s, _ in self._pending], np.int64)
+        offsets = np.concatenate(([0], np.cumsum(lengths)[:-1])).astype(np.int64)
+        samples = np.concatenate([s for s, _ in self._pending])
+        path = os.path.join(self.directory, name)
+        with open(path + ".tmp", "wb") as f:
+            (np.savez_compressed if self.compress else np.savez)(f, samples=samples, offsets=offsets, lengths=lengths)
+        os.replace(path + ".tmp", path)     # The shard is complete before the index sees it
+
+        with self._lock:
+            with open(self.index_path, "a") as f:
+                for (clip, record), offset in zip(self._pending, offsets):
+                    record.update(shard=name, offset=int(offset), length=int(clip.size))
+                    f.write(json.dumps(record) + "\n")
+            self.stored += len(self._pending)
+            self.shards += 1
+        self._next_shard += 1
+        self._pending = []
+
+    def close(self):
+        # Write the partial shard and stop the writer, waits for the queued clips
+        self._queue.put((None, None))
+        self._thread.join()
+
+    def records(self, predicate=None):
+        # Index lines, optionally filtered (e.g. lambda r: r["command"] is not None)
+        if not os.path.exists(self.index_path):
+            return []
+        with self._lock:
+            with open(self.index_path) as f:
+                records = [json.loads(line) for line in f if line.strip()]
+        return [r for r in records if predicate is None or predicate(r)]
+
+    def export(self, predicate=None):
+        # Bulk load for training: (samples, offsets, records), every selected clip in one contiguous int16 array,
+        # clip k is samples[offsets[k]:offsets[k] + records[k]["length"]]. Each shard is opened once.
+        records = self.records(predicate)
+        lengths = np.array([r["length"] for r in records], np.int64)
+        offsets = np.concatenate(([0], np.cumsum(lengths)[:-1])).astype(np.int64) if records else np.zeros(0, np.int64)
+        samples = np.empty(int(lengths.sum()), np.int16)
+
+        by_shard = {}
+        for k, r in enumerate(records):
+            by_shard.setdefault(r["shard"], []).append(k)
+        for shard, selected in by_shard.items():
+            with np.load(os.path.join(self.directory, shard)) as data:
+                source = data["samples"]
+            for k in selected:
+                r = records[k]
+                samples[offsets[k]:offsets[k] + r["length"]] = source[r["offset"]:r["offset"] + r["length"]]
+        return samples, offsets, records
+
+    def stats(self):
+        return {"clips_stored": self.stored, "clips_duplicates": self.duplicates, "clips_dropped": self.dropped,
+                "clips_shards": self.shards, "clips_queued": self._queue.qsize()}
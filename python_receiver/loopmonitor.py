@@ -0,0 +1,121 @@
+'''
+    Event loop lag and GIL contention monitor.
+
+    - Loop lag: a callback rescheduled every <interval> seconds on the receiver loop measures how late it runs
+      (actual - scheduled wake-up). A late callback means the loop thread was busy or was waiting for the GIL.
+    - Sleeps: the time.sleep() of the receiver coroutine goes through sleep(), which accounts the time spent and the
+      overshoot past the requested duration (the GIL held by another thread when the sleep ends).
+    - Per-thread CPU time, as collector values.
+    - A watchdog thread sees the loop stalling while it happens: past <threshold> seconds without a heartbeat it logs
+      a warning with the stack of the loop and of the thread that burned the most CPU meanwhile, so a serial timeout
+      or a restart can be tied to its cause.
+'''
+
+import re
+import sys
+import threading
+import time
+import traceback
+
+from profiler import thread_cpu_times
+
+
+class LoopMonitor:
+
+    def __init__(self, metrics=None, interval=0.1, threshold=0.5):
+        self.metrics = metrics
+        self.interval = interval        # [s] between lag probes
+        self.threshold = threshold      # [s] of stall before the warning, well below the 2 s serial timeout
+        self._loop = None
+        self._handle = None
+        self._loop_ident = None
+        self._expected = 0.0
+        self._beat = None               # time.monotonic() of the last probe, None when not attached
+        self._watchdog = None
+        self._stop = threading.Event()
+
+        # Counters
+        self.lag_max = 0.0
+        self.stalls = 0
+        self.sleep_seconds = 0.0
+        self.sleep_overshoot_max = 0.0
+
+    def attach(self, loop):
+        # Call from the loop thread, at the start of every receiver run
+        self._loop = loop
+        self._loop_ident = threading.get_ident()
+        self._expected = loop.time()
+        self._beat = time.monotonic()
+        self._handle = loop.call_soon(self._probe)
+
+    def detach(self):
+        if self._handle is not None:
+            self._handle.cancel()
+        self._handle = None
+        self._beat = None       # The loop is restarting, not stalled
+
+    def _probe(self):
+        now = self._loop.time()
+        lag = max(now - self._expected, 0.0)
+        self._beat = time.monotonic()
+        self.lag_max = max(self.lag_max, lag)
+        if self.metrics is not None:
+            self.metrics.observe("loop_lag", lag)
+        self._expected = now + self.interval
+        self._handle = self._loop.call_at(self._expected, self._probe)
+
+    def sleep(self, seconds):
+        # time.sleep() for the coroutine, with the time actually lost
+        start = time.monotonic()
+        time.sleep(seconds)
+        slept = time.monotonic() - start
+        self.sleep_seconds += slept
+        overshoot = slept - seconds
+        self.sleep_overshoot_max = max(self.sleep_overshoot_max, overshoot)
+        if self.metrics is not None:
+            self.metrics.observe("loop_sleep_overshoot", max(overshoot, 0.0))
+
+    def start(self):
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog")
+        self._watchdog.daemon = True
+        self._watchdog.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _watch(self):
+        cpu = thread_cpu_times()
+        reported = None
+        while not self._stop.wait(self.interval):
+            beat = self._beat
+            now_cpu = thread_cpu_times()
+            if beat is not None and time.monotonic() - beat > self.threshold:
+                if reported != beat:        # Once per stall
+                    reported = beat
+                    self.stalls += 1
+                    self._report(time.monotonic() - beat, cpu, now_cpu)
+                continue        # Keep the CPU reference of the start of the stall
+            cpu = now_cpu
+
+    def _report(self, stalled, before, after):
+        # The busiest thread since the last heartbeat is the suspect (the loop itself, or one holding the GIL)
+        used = {ident: seconds - before.get(ident, (name, 0.0))[1] for ident, (name, seconds) in after.items()}
+        suspects = sorted((i for i in used if i != threading.get_ident()), key=lambda i: used[i], reverse=True)
+        frames = sys._current_frames()
+        lines = ["Event loop stalled for {0:.2f} s, CPU since the last heartbeat: {1}".format(stalled, ", ".join(
+                 "{0} {1:.3f} s".format(after[i][0], used[i]) for i in suspects[:4]))]
+        for ident in [self._loop_ident] + [i for i in suspects[:1] if i != self._loop_ident]:
+            if ident in frames:
+                name = after[ident][0] if ident in after else str(ident)
+                lines.append("Stack of " + name + " (the loop)" * (ident == self._loop_ident) + ":")
+                lines.append("".join(traceback.format_stack(frames[ident])).rstrip())
+        print("\n".join(lines))
+
+    def stats(self):
+        values = {"loop_lag_max_seconds": round(self.lag_max, 4), "loop_stalls": self.stalls,
+                  "loop_sleep_seconds_total": round(self.sleep_seconds, 3),
+                  "loop_sleep_overshoot_max_seconds": round(self.sleep_overshoot_max, 4)}
+        for ident, (name, seconds) in thread_cpu_times().items():
+            key = "thread_cpu_seconds_" + re.sub(r"[^a-zA-Z0-9_]", "_", name).strip("_").lower()
+            values[key] = values.get(key, 0.0) + round(seconds, 3)
+        return values
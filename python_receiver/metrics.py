@@ -0,0 +1,141 @@
+'''
+    Low overhead metrics for the receiver: latency histograms, counters and a Prometheus-style text endpoint.
+    Everything is kept in plain Python lists guarded by a lock, an observation is a bisect and an increment.
+'''
+
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Upper bounds in seconds, from the single block processing time (~us) to a stuck Wit.ai request
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 1.5, 2.0, 3.0, 5.0, 10.0)
+
+
+class Histogram:
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.bounds = list(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)     # Last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        # Linear interpolation inside the bucket, good enough for a log line
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for k, c in enumerate(self.counts):
+            if seen + c >= rank and c > 0:
+                low = self.bounds[k - 1] if k > 0 else 0.0
+                high = self.bounds[k] if k < len(self.bounds) else self.bounds[-1]
+                return low + (high - low) * (rank - seen) / c
+            seen += c
+        return self.bounds[-1]
+
+
+class Metrics:
+
+    def __init__(self, prefix="pdm_receiver"):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._collectors = []      # Callables returning {name: value}, read only when scraped
+        self._server = None
+
+    def observe(self, name, seconds):
+        with self._lock:
+            h = self._histograms.get(name)
+            if h is None:
+                h = self._histograms[name] = Histogram()
+            h.observe(seconds)
+
+    def inc(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def render(self):
+        # Prometheus text exposition format
+        lines = []
+        with self._lock:
+            for name, value in sorted(self._counters.items()):
+                lines.append("# TYPE {0}_{1} counter".format(self.prefix, name))
+                lines.append("{0}_{1} {2}".format(self.prefix, name, value))
+            for name, h in sorted(self._histograms.items()):
+                full = "{0}_{1}_seconds".format(self.prefix, name)
+                lines.append("# TYPE {0} histogram".format(full))
+                cumulative = 0
+                for bound, c in zip(h.bounds, h.counts):
+                    cumulative += c
+                    lines.append('{0}_bucket{{le="{1}"}} {2}'.format(full, bound, cumulative))
+                lines.append('{0}_bucket{{le="+Inf"}} {1}'.format(full, h.count))
+                lines.append("{0}_sum {1:.6f}".format(full, h.sum))
+                lines.append("{0}_count {1}".format(full, h.count))
+        for collector in self._collectors:
+            try:
+                values = collector()
+            except Exception as e:
+                print("Metrics collector failed: " + str(e))
+                continue
+            for name, value in sorted(values.items()):
+                lines.append("{0}_{1} {2}".format(self.prefix, name, value))
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        with self._lock:
+            parts = ["{0} n={1} p50={2:.3f}s p95={3:.3f}s".format(name, h.count, h.quantile(0.5), h.quantile(0.95))
+                     for name, h in sorted(self._histograms.items()) if h.count]
+        return ", ".join(parts)
+
+    def serve(self, port=9105, host="127.0.0.1"):
+        # Scrape with "curl localhost:9105/metrics", only bound to localhost
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass    # Don't flood the systemctl log at every scrape
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def start_summary(self, interval=60):
+        # Periodic summary on stdout (so in the systemctl status log)
+        def summary_worker():
+            while True:
+                time.sleep(interval)
+                line = self.summary()
+                if line:
+                    print("Latency: " + line)
+
+        thread = threading.Thread(target=summary_worker)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server = None
@@ -2,6 +2,7 @@
 
 import serial
 import signal
+import struct
 import sys
 import wave
 import numpy as np
@@ -28,15 +29,155 @@ fsamp   = 16000
 seconds = 10
 N = seconds * fsamp     # Number of samples to record
 
-# Variables
-x = bytearray()
+chunk = 2048            # Bytes per read, two bursts of the firmware (64 ms), well within the 0.1 s timeout
+max_silence = 2.0       # [s] without any byte before giving up
+
+# Streaming capture
+stream = False          # Record until Ctrl+C in rotating WAV files, constant memory, instead of <seconds> in RAM
+rotate_seconds = 600    # New file every 10 minutes...
+rotate_bytes = None     # ...or every <rotate_bytes> of samples, None to rotate only by duration
+write_queue = 64        # Blocks waiting for the writer thread, 64 * 64 ms == 4 s of slack for a slow SD card
+patch_interval = 5.0    # [s] between header updates, a crash loses at most this much of the current file
+
+
 
-# Recording
-for i in range(N):
-    x.extend(ser.read(2))   # Read 2 bytes at burst, so 1 sample
+'''
+    Streaming capture: the main thread reads, a writer thread appends to the WAV files
+'''
+def wav_header(data_bytes):
+    # 44 bytes PCM header, mono 16 bit
+    return struct.pack("<4sI4s4sIHHIIHH4sI", b"RIFF", 36 + data_bytes, b"WAVE", b"fmt ", 16, 1, 1, fsamp, fsamp * 2, 2, 16,
+                       b"data", data_bytes)
+
+
+class RotatingWav:
+    # Appends samples to "microphone-<date>.wav", the header is rewritten in place every <patch_interval>
+    # seconds so the file is always playable, and a new file is started past <rotate_seconds> or <rotate_bytes>
+
+    def __init__(self):
+        self.f = None
+        self.files = 0
+
+    def open(self):
+        self.close()
+        self.name = time.strftime("microphone-%Y%m%d-%H%M%S.wav")
+        self.f = open(self.name, "wb")
+        self.f.write(wav_header(0))
+        self.data_bytes = 0
+        self.patched_at = time.monotonic()
+        self.files += 1
+        print("Recording to " + self.name)
+
+    def write(self, block):
+        limit = rotate_seconds * fsamp * 2 if rotate_bytes is None else min(rotate_seconds * fsamp * 2, rotate_bytes)
+        if self.f is None or self.data_bytes + len(block) > limit:
+            self.open()
+        self.f.write(block)
+        self.data_bytes += len(block)
+        if time.monotonic() - self.patched_at >= patch_interval:
+            self.patch()
+
+    def patch(self):
+        self.f.seek(0)
+        self.f.write(wav_header(self.data_bytes))
+        self.f.seek(0, 2)
+        self.f.flush()
+        self.patched_at = time.monotonic()
+
+    def close(self):
+        if self.f is not None:
+            self.patch()
+            self.f.close()
+            self.f = None
+
+
+def writer_worker(blocks):
+    wav = RotatingWav()
+    while True:
+        block = blocks.get()
+        if block is None: break
+        wav.write(block)
+    wav.close()
+    print("Recorded {0} file(s)".format(wav.files))
+
+
+def capture_stream():
+    # The blocks cycle in a pool one larger than the queue plus the one being written, nothing else is allocated
+    pool = [bytearray(chunk) for _ in range(write_queue + 2)]
+    blocks = Queue(write_queue)
+    writer = Thread(target=writer_worker, args=(blocks,))
+    writer.start()
+
+    k = 0
+    received = 0
+    short_reads = 0
+    dropped = 0
+    start = time.monotonic()
+    last_data = start
+    try:
+        while True:
+            block = memoryview(pool[k])
+            filled = 0
+            while filled < chunk:       # Whole blocks only, so every file holds whole samples
+                n = ser.readinto(block[filled:])
+                now = time.monotonic()
+                if n < chunk - filled:
+                    short_reads += 1
+                if n:
+                    last_data = now
+                elif now - last_data > max_silence:
+                    raise TimeoutError("No data for {0} s, stopping".format(max_silence))
+                filled += n
+            received += chunk
+            if blocks.full():
+                dropped += 1            # The writer is behind, keep reading the port rather than losing data in the OS
+                continue
+            blocks.put(pool[k])
+            k = (k + 1) % len(pool)
+    except KeyboardInterrupt:
+        pass
+    except TimeoutError as e:
+        print(e)
+    finally:
+        blocks.put(None)
+        writer.join()
+    elapsed = time.monotonic() - start
+    print("Received {0} bytes in {1:.2f} s, {2:.0f} B/s (expected {3} B/s), {4} short reads, {5} blocks dropped".format(
+          received, elapsed, received / elapsed if elapsed else 0, fsamp * 2, short_reads, dropped))
+
+
+if stream:
+    capture_stream()
+    ser.close()
+    sys.exit(0)
 
-# Convert buffer in numpy array
-y = np.frombuffer(x, np.int16)
+
+# Variables
+y = np.zeros(N, np.int16)           # Preallocated, the serial data land directly in it
+x = memoryview(y).cast("B")         # Same memory seen as bytes, an odd short read just continues at the next byte
+received = 0
+short_reads = 0
+
+# Recording, one Python call every <chunk> bytes instead of every sample
+start = time.monotonic()
+last_data = start
+while received < N * 2:
+    wanted = min(chunk, N * 2 - received)
+    n = ser.readinto(x[received:received + wanted])
+    now = time.monotonic()
+    if n < wanted:
+        short_reads += 1    # The timeout expired first: the host or the device stalled
+    if n:
+        last_data = now
+    elif now - last_data > max_silence:
+        print("No data for {0} s, stopping".format(max_silence))
+        break
+    received += n
+elapsed = time.monotonic() - start
+
+y = y[:received // 2]
+print("Received {0} bytes in {1:.2f} s, {2:.0f} B/s (expected {3} B/s), {4} short reads".format(
+      received, elapsed, received / elapsed if elapsed else 0, fsamp * 2, short_reads))
 
 # Stop Streaming
 ser.reset_input_buffer()
@@ -53,7 +194,7 @@ wavfile.write(wavname, fsamp, np.asarray(y, np.int16))
 # Another save method
 '''
 # write audio to a WAV file
-audio = sr.AudioData(x, fsamp, 2)
+audio = sr.AudioData(y.tobytes(), fsamp, 2)
 
 with open("microphone-results.wav", "wb") as f:
     f.write(audio.get_wav_data())
@@ -65,7 +206,7 @@ with wave.open('file.wav', "wb") as wav:
     wav.setframerate(fsamp)
     wav.setnchannels(1)
     wav.setsampwidth(2)     # 2 because of 16 bit samples, 2 * 8 bit
-    wav.writeframes(x)
+    wav.writeframes(y.tobytes())
 '''
 
 # You know what this do
@@ -0,0 +1,146 @@
+'''
+    In-process sampling profiler, started and stopped at runtime (SIGUSR1 / SIGUSR2 in recognizer.py).
+
+    While running, a daemon thread snapshots the stack of every other thread with sys._current_frames() every
+    <interval> seconds: the asyncio receiver, the recognizer workers, the paho MQTT loop, the metrics server. It's a
+    wall-clock profiler, a thread blocked in select() or in a lock shows where it waits, which is what explains a
+    timeout. When stopped it writes two files:
+
+    - <name>.collapsed  one "thread;file:function;...;file:function count" line per distinct stack, ready for
+                        flamegraph.pl or speedscope
+    - <name>.top        the per-thread CPU time of the session and the top-N functions by self and total samples
+
+    Nothing samples while it's stopped. The signal handlers only post a request, a control thread blocked on it
+    starts and stops the sampler and writes the files, so a signal landing while a lock is held can't deadlock.
+'''
+
+import collections
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+
+
+def thread_cpu_times():
+    # CPU seconds of every live thread, {ident: (name, seconds)}. Linux only (pthread_getcpuclockid), empty elsewhere
+    values = {}
+    if not hasattr(time, "pthread_getcpuclockid"):
+        return values
+    for thread in threading.enumerate():
+        try:
+            values[thread.ident] = (thread.name, time.clock_gettime(time.pthread_getcpuclockid(thread.ident)))
+        except (OSError, TypeError):
+            pass        # Thread exited in the meantime
+    return values
+
+
+def frame_label(code):
+    return "{0}:{1}".format(os.path.basename(code.co_filename), code.co_name)
+
+
+class SamplingProfiler:
+
+    def __init__(self, directory=".", interval=0.005, top=25):
+        self.directory = directory
+        self.interval = interval        # [s] between samples, 5 ms is ~1% of a Pi 4 core
+        self.top = top
+        self._thread = None
+        self._running = threading.Event()
+        self._lock = threading.Lock()
+        self._requests = queue.SimpleQueue()    # "start" / "stop" from the signal handlers
+        self._control = None
+
+    @property
+    def running(self):
+        return self._running.is_set()
+
+    def handle_signals(self, start, stop):
+        # Install the handlers, from the main thread. SimpleQueue.put() is reentrant, the only thing a handler may do
+        if self._control is None:
+            self._control = threading.Thread(target=self._serve, name="profiler-control")
+            self._control.daemon = True
+            self._control.start()
+        signal.signal(start, lambda sig, frame: self._requests.put("start"))
+        signal.signal(stop, lambda sig, frame: self._requests.put("stop"))
+
+    def _serve(self):
+        while True:
+            if self._requests.get() == "start":
+                self.start()
+            else:
+                self.stop()
+
+    def start(self):
+        # Not from a signal handler (see handle_signals()), a second start is ignored
+        with self._lock:
+            if self._running.is_set():
+                return False
+            self._stacks = collections.Counter()
+            self._samples = 0
+            self._started_at = time.monotonic()
+            self._cpu_start = thread_cpu_times()
+            self._running.set()
+            self._thread = threading.Thread(target=self._sample, name="profiler")
+            self._thread.daemon = True
+            self._thread.start()
+        print("Profiler started, sampling every {0} ms".format(self.interval * 1000))
+        return True
+
+    def stop(self):
+        # Stop sampling and write the files, returns their base path (None if it wasn't running)
+        with self._lock:
+            if not self._running.is_set():
+                return None
+            self._running.clear()
+            thread = self._thread
+        thread.join()
+        path = self.dump()
+        print("Profiler stopped, {0} samples in {1}.collapsed and {1}.top".format(self._samples, path))
+        return path
+
+    def _sample(self):
+        me = threading.get_ident()
+        while self._running.is_set():
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame_label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self._stacks[tuple(reversed(stack))] += 1
+            self._samples += 1
+            time.sleep(self.interval)
+
+    def dump(self):
+        elapsed = time.monotonic() - self._started_at
+        base = os.path.join(self.directory, time.strftime("profile-%Y%m%d-%H%M%S"))
+        with open(base + ".collapsed", "w") as f:
+            for stack, count in self._stacks.most_common():
+                f.write(";".join(stack) + " " + str(count) + "\n")
+
+        own = collections.Counter()         # Samples with the function on top of the stack
+        total = collections.Counter()       # Samples with the function anywhere in the stack, counted once
+        for stack, count in self._stacks.items():
+            thread = stack[0]
+            own[(thread, stack[-1])] += count
+            for label in set(stack[1:]):
+                total[(thread, label)] += count
+
+        cpu_end = thread_cpu_times()
+        with open(base + ".top", "w") as f:
+            f.write("{0} samples in {1:.1f} s, every {2} ms\n\n".format(self._samples, elapsed, self.interval * 1000))
+            f.write("CPU time per thread during the session\n")
+            for ident, (name, seconds) in sorted(cpu_end.items(), key=lambda item: item[1][0]):
+                used = seconds - self._cpu_start.get(ident, (name, 0.0))[1]
+                f.write("  {0:<40} {1:8.3f} s {2:6.1f}%\n".format(name, used, 100 * used / elapsed if elapsed else 0))
+            for title, counter in (("Self", own), ("Total", total)):
+                f.write("\n{0} samples, top {1}\n".format(title, self.top))
+                for (thread, label), count in counter.most_common(self.top):
+                    f.write("  {0:6.1f}% {1:7d}  {2:<30} {3}\n".format(100 * count / self._samples if self._samples else 0,
+                                                                      count, thread, label))
+        return base
@@ -12,11 +12,23 @@ import signal
 import os
 import sys
 import subprocess
+import collections
+import multiprocessing
+import contextvars
+import functools
 from threading import Event
 from threading import Thread
-from queue import Queue
+from threading import Condition
+from threading import Lock
 import paho.mqtt.client as mqtt
 import paho.mqtt.publish as publish
+from metrics import Metrics
+from archive import AudioArchive
+from clipstore import ClipStore
+import replay
+from shmring import SharedUtteranceRing
+from profiler import SamplingProfiler
+from loopmonitor import LoopMonitor
 
 if os.name == "posix":
     import uvloop
@@ -30,56 +42,787 @@ if os.name == "posix":
 if os.name == "posix":
     asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())    # Only for Linux
 
+# Signal processing, every board
+fsamp = 16000
+bufsize = 512               # Samples per serial block, the 'x' of receiver()
+conversion = 32             # 32 conversion * 512 bufsize == 1 second at 16KHz of sample rate (almost, 16384 samples == 1.024 s, the real rate is in device.accounting.rate)
+seconds_to_reset = 200      # Length of the ring buffer 'y' [seconds] (almost)
+listening_for = 1.5         # * conversion == [second/bufsize] captured after a trigger
+
+# Boards, one per room, all in the same event loop and sharing the recognizers and the MQTT client (see Device below)
+devices = []                # [{"name": "kitchen", "port": "/dev/serial/by-id/usb-Arduino_Nano_33_BLE-if00", "shelly_id": "shellyplus1-..."}, ...],
+                            # empty for the single board found on ACM (or <source>) switching <shelly_id>
+device_list = []            # Device objects, created in main()
+
+# Utterance buffers
+queue_size = 4              # Max utterances waiting for the recognizer, older/newer ones are dropped according to the policy
+overload_policy = "drop-oldest"     # "drop-oldest", "drop-newest" or "coalesce" (adjacent triggers of a board make one utterance, then drop-oldest)
+coalesce_window = 1.0       # [s] with "coalesce", a re-trigger this soon after the end of a capture extends it...
+coalesce_max = 4.0          # ...up to this many seconds after the first trigger
+recognition_workers = 2     # Wit.ai requests in flight at the same time
+async_recognition = False   # Run the requests as tasks of the receiver loop (needs aiohttp) instead of worker threads
+recognition_processes = 0   # Recognize in this many worker processes instead (CPU-bound engines like "vosk"), clips handed over in shared memory
+
+# Trigger
+trigger = "peak"            # "peak", "rms" or "voice" (300-3400 Hz band energy), see the detectors below
+trigger_volume = 18000      # If the audio samples have magnitude greater than this start listening ("peak")
+trigger_rms = 3000          # Same for the "rms" and "voice" detectors, on the block (band) RMS
+trigger_auto = True         # Track the room noise floor and move the threshold with it, the values above become the ceiling
+trigger_margin = 4.0        # Threshold = noise floor * margin (x4 == +12 dB)
+trigger_release = 2.0       # After a trigger, re-arm only once a block drops below noise floor * release
+noise_quantile = 0.2        # Noise floor == this quantile of the block levels
+
+# Trigger admission control, every admitted trigger costs a Wit.ai request (see AdmissionControl)
+admission = True            # False lets every trigger through
+admission_rate = 6.0        # Triggers per minute and board on average...
+admission_burst = 3         # ...with bursts of this many
+admission_misses = 3        # After this many recognitions in a row without a command...
+admission_cooldown = 60.0   # ...the board ignores its trigger for this long [s]
+admission_overlap = True    # No new capture while the previous one of the board is still being recognized
+
+# Silence trimming before upload
+trim = True                 # Send only the speech (plus a margin) instead of the whole 2.5 s clip
+trim_margin = 0.2           # [s] kept before the onset and after the offset
+trim_ratio = 3.0            # A frame is speech if its RMS is above the quietest frames * ratio...
+trim_min_rms = 300          # ...and above this
+
+# Upload payload, see encode_audio() in the speech_recognition update
+wit_encoding = "wav"        # "wav", "raw" or "mulaw" (half the bytes), benchmark them with benchmarks/bench_encodings.py
+wit_rate = None             # 8000 halves the payload again, None keeps 16 kHz
+engines = ["wit"]           # More than one ("wit", "wit_new", "vosk") races them, the first one hearing a command wins
+recognizers = []            # One per worker, for the engines statistics
+deadline_budget = 4.0       # [s] from the trigger, past this switching the light is useless and the request is abandoned
+hedge_quantile = 0.9        # Send a duplicate request when the first one is slower than this quantile of the past ones, None to disable
+wit_api_url = None          # None for https://api.wit.ai, or a stand-in like benchmarks/fake_wit.py
+
+# Raw audio archive, see archive.py
+archive_dir = None          # Directory for the always-on archive of the stream (e.g. "/home/tito/pdm-archive"), None to disable
+archive_max_bytes = 4 * 1024**3     # Oldest segments deleted past this size...
+archive_max_age = 7 * 24 * 3600     # ...or this age [s]
+archive_segment_seconds = 600       # 19 MB files at 16 kHz
+archive = None              # Created in main(), query it with archive.query(start, end) (time.time() values). With <devices> every
+                            # board has its own in archive_dir/<name>, device.archive
+
+# Labelled clips, see clipstore.py
+clip_store_dir = None       # Directory where every recognized clip is kept with its transcript, None to disable
+clip_store = None           # Created in main(), clip_store.export() loads them all for training
+
+# Offline replay, see replay.py
+source = None               # None searches the Arduino, a .wav/.bin recording is replayed, any other path is opened as a serial port (e.g. a pty)
+replay_speed = 1.0          # The recording is played at this times real time, 0 as fast as possible
+serial_pause = 0.032        # [s] of sleep before every serial read (see receiver()), benchmarks/bench_receiver.py scales it with the replay
+
+# Latency instrumentation
+metrics = Metrics()
+metrics_port = 9105         # Prometheus-style text on http://localhost:9105/metrics, None to disable
+metrics_summary_interval = 60   # [s] between latency summaries on the log
+
+# On-demand profiling, "kill -USR1 <pid>" starts it and "kill -USR2 <pid>" writes profile-<date>.collapsed/.top
+profile_dir = "/tmp"
+profile_interval = 0.005    # [s] between stack samples
+profiler = SamplingProfiler(profile_dir, profile_interval)
+
+# Event loop lag and GIL contention, see loopmonitor.py
+monitor_interval = 0.1      # [s] between loop lag probes
+monitor_threshold = 0.5     # [s] without a probe before logging the stacks, the serial read times out at 2 s
+loop_monitor = LoopMonitor(metrics, monitor_interval, monitor_threshold)
+
 # Threading controls
-audio_queue = Queue()
+audio_queue = None          # Created in main(), see UtteranceQueue below
+workers = []                # Recognizer threads
 event = Event()
 stop = Event()
 
 # MQTT
 mqttc = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+mqtt_broker = "localhost"   # Default, you can change it to the IP address your broker
+mqtt_port = 1883
 shelly_id = "<shelly id>"   # Given on MQTT section of the Internet section in the setting of the Shelly Device
 
 
 
 
+'''
+    Bounded utterance queue backed by a pool of preallocated buffers
+'''
+class Utterance:
+    # Handle to a pooled buffer, give it back with UtteranceQueue.release() once recognized
+    __slots__ = ("slot", "samples", "captured_at", "seq", "triggered_at", "trigger_level", "device", "dequeued_at")
+
+    def __init__(self, slot, samples):
+        self.slot = slot
+        self.samples = samples      # View on the pool row, as long as its clip, never reallocated
+        self.captured_at = 0.0
+        self.seq = 0                # Capture order, given by put()
+        self.triggered_at = 0.0     # time.monotonic() of the serial block that fired the trigger
+        self.trigger_level = 0.0    # Detector level of that block
+        self.device = 0             # Index of the board in device_list
+        self.dequeued_at = 0.0
+
+
+class UtteranceQueue:
+
+    def __init__(self, maxsize, clip_samples, in_flight=1, policy="drop-oldest"):
+        if policy not in ("drop-oldest", "drop-newest", "coalesce"):
+            raise ValueError("Unknown overload policy: " + str(policy))
+        self.maxsize = maxsize
+        self.policy = policy
+
+        # One slot for every queued clip plus the ones the recognizer is working on, allocated once
+        self._pool = np.zeros((maxsize + in_flight, clip_samples), np.int16)
+        self._slots = [Utterance(k, self._pool[k]) for k in range(len(self._pool))]
+        self._free = collections.deque(self._slots)
+        self._queue = collections.deque()
+        self._closed = False
+        self._not_empty = Condition()
+        self._next_seq = 0
+
+        # Counters
+        self.enqueued = 0
+        self.dropped_oldest = 0
+        self.dropped_newest = 0
+
+    def put(self, clip, triggered_at=None, trigger_level=0.0, device=0):
+        # Called from the asyncio loop, never blocks: copy the clip in a free buffer or apply the overload policy
+        now = time.monotonic()
+        with self._not_empty:
+            if self._closed:
+                return False
+
+            if len(self._queue) < self.maxsize and self._free:
+                utt = self._free.popleft()
+            elif self.policy == "drop-newest" or not self._queue:
+                self.dropped_newest += 1
+                return False
+            else:
+                utt = self._queue.popleft()
+                self.dropped_oldest += 1
+
+            utt.samples = self._pool[utt.slot, :clip.size]     # Coalesced captures are longer
+            utt.samples[:] = clip
+            utt.captured_at = now
+            utt.triggered_at = now if triggered_at is None else triggered_at
+            utt.trigger_level = trigger_level
+            utt.device = device
+            self._next_seq += 1
+            utt.seq = self._next_seq
+            self._queue.append(utt)
+            self.enqueued += 1
+            self._not_empty.notify()
+            return True
+
+    def get(self):
+        # Blocking, return None when the queue has been closed and drained
+        with self._not_empty:
+            while not self._queue and not self._closed:
+                self._not_empty.wait()
+            if not self._queue:
+                return None
+            utt = self._queue.popleft()
+        utt.dequeued_at = time.monotonic()
+        return utt
+
+    def get_nowait(self):
+        # Non-blocking get for the event loop, None when nothing is waiting
+        with self._not_empty:
+            if not self._queue:
+                return None
+            utt = self._queue.popleft()
+        utt.dequeued_at = time.monotonic()
+        return utt
+
+    def release(self, utt):
+        # The recognizer is done with the buffer, put it back in the pool
+        with self._not_empty:
+            self._free.append(utt)
+
+    def clear(self, device=None):
+        # Drop the waiting clips (of one board only) without touching the ones in flight
+        with self._not_empty:
+            kept = collections.deque()
+            while self._queue:
+                utt = self._queue.popleft()
+                if device is None or utt.device == device:
+                    self._free.append(utt)
+                else:
+                    kept.append(utt)
+            self._queue = kept
+
+    def close(self):
+        with self._not_empty:
+            self._closed = True
+            self._not_empty.notify_all()
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def stats(self):
+        with self._not_empty:
+            return {"queued": len(self._queue), "free": len(self._free), "enqueued": self.enqueued,
+                    "dropped_oldest": self.dropped_oldest, "dropped_newest": self.dropped_newest}
+
+
+
+
+'''
+    Apply the recognized commands in capture order
+'''
+class CommandSequencer:
+    # Recognitions run concurrently and can complete out of order: a command is published only if no later
+    # capture has already switched the light, so a slow "accendi" can't override a newer "spegni"
+
+    def __init__(self):
+        self._lock = Lock()
+        self.last_applied = 0
+        self.stale = 0
+
+    def apply(self, seq, send):
+        with self._lock:
+            if seq < self.last_applied:
+                self.stale += 1
+                return False
+            self.last_applied = seq
+            send()          # Inside the lock, so the publish order is the capture order
+            return True
+
+
+
+
+'''
+    Sample accounting on the serial stream
+'''
+class StreamAccounting:
+    # The firmware sends raw 1024 bytes bursts, no framing and no sequence numbers, so compare the samples received
+    # with what a 16 kHz source should have produced according to the monotonic clock.
+    # lag = expected - received is how far behind the host is (data waiting in the USB/OS/asyncio buffers): it goes
+    # up when we stall or fall behind and back down when we catch up. Overruns are measured from the lowest lag of
+    # the session, so a steady fall-behind adds up. A loss is a step of the lag floor inside one window (samples that
+    # will never arrive), not the gradual rise of a host that is just slow.
+
+    def __init__(self, fsamp, block, window=5.0, step=0.5, gap_factor=3.0, loss_tolerance=0.05, overrun_threshold=0.5):
+        self.fsamp = fsamp
+        self.block_period = block / fsamp
+        self.window = window                    # [s] between rate and loss evaluations
+        self.step = step                        # [s] of the sub-windows whose floors reveal a step
+        self.gap_factor = gap_factor            # A block later than gap_factor * 32 ms is a gap
+        self.loss_tolerance = loss_tolerance    # [s] of floor step before declaring a loss
+        self.overrun_threshold = overrun_threshold  # [s] behind the session floor before declaring an overrun
+
+        # Counters, they survive reconnections
+        self.samples = 0
+        self.gaps = 0
+        self.overruns = 0
+        self.losses = 0
+        self.lost_samples = 0
+        self.longest_gap = 0.0
+        self.rate = 0.0         # Effective sample rate over the last window
+        self.lag = 0.0          # [s] behind real time, at the last block
+        self.start(None)
+
+    def start(self, now):
+        # Call on every (re)connection, the device clock has nothing to do with the previous session
+        self._t0 = now
+        self._last_at = now
+        self._received = 0
+        self._window_at = now
+        self._window_received = 0
+        self._window_floor = None
+        self._floor = None          # Floor of the previous window
+        self._base = None           # Lowest lag of the session (raised by the losses)
+        self._step_at = now
+        self._step_floor = None     # Floor of the current sub-window...
+        self._prev_step_floor = None    # ...and of the previous one
+        self._max_step = 0.0        # Largest rise between consecutive sub-windows in this window...
+        self._prev_max_step = 0.0   # ...and in the previous one, a step late in a window lifts the floor of the next
+        self._overrun = False
+
+    def block(self, n, now):
+        self.samples += n
+        if self._t0 is None:
+            # First block is the reference, it may carry data buffered before we started reading
+            self.start(now)
+            return
+
+        interval = now - self._last_at
+        self._last_at = now
+        if interval > self.gap_factor * self.block_period:
+            self.gaps += 1
+            self.longest_gap = max(self.longest_gap, interval)
+
+        self._received += n
+        self._window_received += n
+        lag = now - self._t0 - self._received / self.fsamp
+        self.lag = lag
+        if self._window_floor is None or lag < self._window_floor:
+            self._window_floor = lag
+        if self._step_floor is None or lag < self._step_floor:
+            self._step_floor = lag
+        if self._base is None or lag < self._base:
+            self._base = lag
+
+        if lag - self._base > self.overrun_threshold:
+            if not self._overrun:
+                self._overrun = True
+                self.overruns += 1
+                print("Serial overrun, {0:.2f} s behind the microphone".format(lag - self._base))
+        else:
+            self._overrun = False
+
+        if now - self._step_at >= self.step:
+            if self._prev_step_floor is not None:
+                self._max_step = max(self._max_step, self._step_floor - self._prev_step_floor)
+            self._prev_step_floor = self._step_floor
+            self._step_floor = None
+            self._step_at = now
+
+        if now - self._window_at >= self.window:
+            self.rate = self._window_received / (now - self._window_at)
+            jump = 0.0
+            if self._floor is not None:
+                # Only the part of the rise that happened as a step, a steady slope is not a loss
+                jump = min(self._window_floor - self._floor, max(self._max_step, self._prev_max_step))
+                if jump > self.loss_tolerance:
+                    lost = int(jump * self.fsamp)
+                    self.losses += 1
+                    self.lost_samples += lost
+                    self._base += jump      # Those samples will never come, it's not the host falling behind
+                    print("Serial stream lost about {0} samples".format(lost))
+            self._floor = self._window_floor
+            self._window_at = now
+            self._window_received = 0
+            self._window_floor = None
+            self._prev_max_step = self._max_step if jump <= self.loss_tolerance else 0.0
+            self._max_step = 0.0
+
+    def stats(self):
+        return {"stream_samples": self.samples, "stream_gaps": self.gaps, "stream_overruns": self.overruns,
+                "stream_losses": self.losses, "stream_lost_samples": self.lost_samples,
+                "stream_longest_gap_seconds": round(self.longest_gap, 4), "stream_rate_hz": round(self.rate, 1),
+                "stream_lag_seconds": round(self.lag, 4)}
+
+
+
+
+'''
+    Int16 frame alignment on the serial stream
+'''
+class FrameAligner:
+    # If a single byte is lost on the USB CDC link every following sample is made of the high byte of one sample
+    # and the low byte of the next one. Audio is smooth at the right offset, while at the wrong one the low bytes
+    # (almost noise) end up in the high half, so compare the mean absolute first difference at both byte offsets.
+
+    def __init__(self, ratio=0.25, confirm=3):
+        self.ratio = ratio          # The other offset must be this much smoother...
+        self.confirm = confirm      # ...for this many consecutive blocks before dropping a byte
+        self.votes = 0
+        self.realignments = 0
+
+    def check(self, data):
+        # True when the stream is shifted by one byte and the caller must drop one
+        here = np.frombuffer(data, np.int16).astype(np.int32)
+        shifted = np.frombuffer(data, np.int16, count=len(data) // 2 - 1, offset=1).astype(np.int32)
+        roughness = np.abs(np.diff(here)).mean()
+        if np.abs(np.diff(shifted)).mean() < self.ratio * roughness:
+            self.votes += 1
+        else:
+            self.votes = 0
+        if self.votes >= self.confirm:
+            self.votes = 0
+            self.realignments += 1
+            return True
+        return False
+
+    def stats(self):
+        return {"stream_realignments": self.realignments}
+
+
+
+
+'''
+    Trigger detectors, called on every 512 samples block
+'''
+class TriggerDetector:
+    # Subclasses implement level(x), the block triggers when level >= threshold
+
+    name = "base"
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.value = 0.0        # Level of the last block
+        self.blocks = 0
+        self.cost = 0.0         # [s] spent in level(), to compare the detectors
+
+    def __call__(self, x):
+        start = time.perf_counter()
+        self.value = self.level(x)
+        self.cost += time.perf_counter() - start
+        self.blocks += 1
+        return self.value >= self.threshold
+
+    def level(self, x):
+        raise NotImplementedError
+
+    def stats(self):
+        return {"trigger_" + self.name + "_blocks": self.blocks,
+                "trigger_" + self.name + "_cost_per_block_seconds": self.cost / self.blocks if self.blocks else 0.0}
+
+
+class PeakDetector(TriggerDetector):
+    # Absolute peak, the negative half of the waveform counts too
+    name = "peak"
+
+    def level(self, x):
+        return max(int(x.max()), -int(x.min()))
+
+
+class RmsDetector(TriggerDetector):
+    # Block energy, a single click doesn't carry enough of it
+    name = "rms"
+
+    def level(self, x):
+        x = x.astype(np.float32)
+        return math.sqrt(float(np.dot(x, x)) / x.size)
+
+
+class VoiceBandDetector(TriggerDetector):
+    # RMS of the 300-3400 Hz band, only if that band holds at least <min_ratio> of the block energy:
+    # door slams (low frequencies) and clicks (broadband) are rejected, quiet speech still passes
+    name = "voice"
+
+    def __init__(self, threshold, fsamp=16000, low=300, high=3400, min_ratio=0.5):
+        super().__init__(threshold)
+        self.fsamp = fsamp
+        self.low = low
+        self.high = high
+        self.min_ratio = min_ratio
+        self.ratio = 0.0
+        self._size = None
+
+    def _prepare(self, size):
+        # Window and band mask cached for the block size, computed once
+        self._size = size
+        self._window = np.hanning(size).astype(np.float32)
+        freqs = np.fft.rfftfreq(size, 1.0 / self.fsamp)
+        self._band = (freqs >= self.low) & (freqs <= self.high)
+        self._scale = 2.0 / (size * float(np.dot(self._window, self._window)))     # Parseval, one-sided spectrum
+
+    def level(self, x):
+        if x.size != self._size:
+            self._prepare(x.size)
+        power = np.abs(np.fft.rfft(x * self._window)) ** 2
+        total = float(power[1:].sum())      # Without DC
+        if total == 0.0:
+            self.ratio = 0.0
+            return 0.0
+        band = float(power[self._band].sum())
+        self.ratio = band / total
+        if self.ratio < self.min_ratio:
+            return 0.0
+        return math.sqrt(band * self._scale)
+
+
+detectors = {"peak": lambda: PeakDetector(trigger_volume), "rms": lambda: RmsDetector(trigger_rms),
+             "voice": lambda: VoiceBandDetector(trigger_rms, fsamp)}
+
+
+
+
+'''
+    Automatic trigger threshold from a rolling noise floor
+'''
+class NoiseFloor:
+    # Streaming quantile of the block levels, O(1) per block and no memory: the estimate moves by a small
+    # step in the log domain, up with weight q and down with weight 1 - q, so it settles where a fraction q
+    # of the blocks is below it. Same spirit as Recognizer.adjust_for_ambient_noise(), but it can run forever.
+
+    def __init__(self, quantile=0.2, step=0.005):
+        self.quantile = quantile
+        self.step = step
+        self._log = None
+
+    def update(self, value):
+        v = math.log(max(value, 1.0))
+        if self._log is None:
+            self._log = v
+        elif v > self._log:
+            self._log += self.step * self.quantile
+        else:
+            self._log -= self.step * (1 - self.quantile)
+
+    @property
+    def level(self):
+        return math.exp(self._log) if self._log is not None else 0.0
+
+
+class AdaptiveTrigger:
+    # Wraps a TriggerDetector and keeps its threshold at noise floor * margin, between minimum and maximum.
+    # Hysteresis: after firing, it stays disarmed until a block drops below noise floor * release.
+
+    def __init__(self, detector, margin=4.0, release=2.0, quantile=0.2, minimum=None, maximum=None):
+        self.detector = detector
+        self.margin = margin
+        self.release = release
+        self.floor = NoiseFloor(quantile)
+        self.maximum = detector.threshold if maximum is None else maximum
+        self.minimum = self.maximum / 8 if minimum is None else minimum
+        self.armed = True
+        self.fired = 0
+
+    @property
+    def threshold(self):
+        return self.detector.threshold
+
+    @property
+    def value(self):
+        return self.detector.value
+
+    def __call__(self, x):
+        above = self.detector(x)
+        value = self.detector.value
+
+        # Every block feeds the estimate: the low quantile already ignores speech, and a louder steady noise (a fan,
+        # the AC) must move the floor, or every block stays above the threshold and the trigger never re-arms
+        self.floor.update(value)
+        self.detector.threshold = min(max(self.floor.level * self.margin, self.minimum), self.maximum)
+
+        if above:
+            if self.armed:
+                self.armed = False
+                self.fired += 1
+                return True
+            return False
+
+        if not self.armed and value < self.floor.level * self.release:
+            self.armed = True
+        return False
+
+    def stats(self):
+        values = self.detector.stats()
+        values.update({"trigger_noise_floor": round(self.floor.level, 1), "trigger_threshold": round(self.detector.threshold, 1),
+                       "trigger_fired": self.fired})
+        return values
+
+
+class AdmissionControl:
+    # Sits between the trigger and the queue of one board, a TV or a party must not become dozens of requests a minute:
+    # - token bucket: <rate> triggers per minute on average, bursts of <burst>
+    # - cooldown: after <misses> recognitions in a row without a command, no trigger for <cooldown> seconds
+    # - overlap: no new capture while the previous one is still being recognized (at most until its deadline)
+    # admit() runs in the event loop, done() in the recognizers, hence the lock.
+
+    def __init__(self, rate=6.0, burst=3, misses=3, cooldown=60.0, overlap=True):
+        self.rate = rate / 60.0     # Tokens per second
+        self.burst = burst
+        self.misses = misses
+        self.cooldown = cooldown
+        self.overlap = overlap
+        self._lock = Lock()
+        self._tokens = float(burst)
+        self._refilled_at = None
+        self._missed = 0
+        self._cooling_until = 0.0
+        self._in_flight = None      # (triggered_at, deadline) of the last queued capture
+
+        # Counters
+        self.admitted = 0
+        self.rejected_rate = 0
+        self.rejected_cooldown = 0
+        self.rejected_overlap = 0
+        self.cooldowns = 0
+
+    def admit(self, now):
+        # Start a capture for the trigger at <now>? Only an admitted trigger consumes a token
+        with self._lock:
+            if self._refilled_at is not None:
+                self._tokens = min(self._tokens + (now - self._refilled_at) * self.rate, self.burst)
+            self._refilled_at = now
+
+            if self.overlap and self._in_flight is not None and now < self._in_flight[1]:
+                self.rejected_overlap += 1
+                return False
+            if now < self._cooling_until:
+                self.rejected_cooldown += 1
+                return False
+            if self._tokens < 1.0:
+                self.rejected_rate += 1
+                return False
+            self._tokens -= 1.0
+            self.admitted += 1
+            return True
+
+    def captured(self, triggered_at, deadline):
+        # The capture is queued, it's in flight until done() or its deadline
+        with self._lock:
+            self._in_flight = (triggered_at, deadline)
+
+    def done(self, triggered_at, heard):
+        # End of a recognition: <heard> True for a command, False for none, None when it failed (not the audio's fault)
+        with self._lock:
+            if self._in_flight is not None and self._in_flight[0] == triggered_at:
+                self._in_flight = None
+            if heard is None:
+                return False
+            if heard:
+                self._missed = 0
+                return False
+            self._missed += 1
+            if self._missed < self.misses:
+                return False
+            self._missed = 0
+            self._cooling_until = time.monotonic() + self.cooldown
+            self.cooldowns += 1
+            return True         # Cooling down from now
+
+    def stats(self):
+        with self._lock:
+            return {"admission_admitted": self.admitted, "admission_rejected_rate": self.rejected_rate,
+                    "admission_rejected_cooldown": self.rejected_cooldown, "admission_rejected_overlap": self.rejected_overlap,
+                    "admission_cooldowns": self.cooldowns, "admission_tokens": round(self._tokens, 2)}
+
+
+def make_trigger():
+    # One per board, every room has its own noise floor
+    detector = detectors[trigger]()
+    if trigger_auto:
+        detector = AdaptiveTrigger(detector, trigger_margin, trigger_release, noise_quantile)
+    return detector
+
+
+
+
+'''
+    Silence trimming of the captured clips
+'''
+def trim_silence(samples, fsamp, margin=0.2, ratio=3.0, min_rms=300, frame=320):
+    # Return (start, end) of the speech in 'samples', vectorised on 20 ms frames.
+    # The whole clip is kept when no frame stands out of the noise, let the engine decide.
+    frames = samples[:samples.size - samples.size % frame].reshape(-1, frame).astype(np.float32)
+    rms = np.sqrt(np.einsum("ij,ij->i", frames, frames) / frame)
+    threshold = max(np.percentile(rms, 10) * ratio, min_rms)
+    speech = np.flatnonzero(rms > threshold)
+    if speech.size == 0:
+        return 0, samples.size
+    pad = int(margin * fsamp)
+    start = max(int(speech[0]) * frame - pad, 0)
+    end = min((int(speech[-1]) + 1) * frame + pad, samples.size)
+    return start, end
+
+
+
+
+'''
+    Per-board state
+'''
+class Device:
+    # Everything that belongs to one board: its serial stream, ring buffer, trigger and the Shelly of its room.
+    # The event loop, the utterance queue with the recognizers and the MQTT client are shared by all of them.
+
+    def __init__(self, index, name, port=None, shelly=None):
+        self.index = index          # Travels with its utterances, also to the worker processes
+        self.name = name            # Room, labels the metrics and the stored clips
+        self.port = port            # Serial port or recording, None searches the ACM port (single board only)
+        self.shelly_id = shelly
+        self.archive = None         # AudioArchive of this board, created in main()
+        self.accounting = StreamAccounting(fsamp, bufsize)
+        self.aligner = FrameAligner()
+        self.trigger = make_trigger()
+        self.sequencer = CommandSequencer()     # Capture order is per room, a command here never makes another room's stale
+        self.admission = AdmissionControl(admission_rate, admission_burst, admission_misses, admission_cooldown,
+                                          admission_overlap) if admission else None
+        self.last_publish_at = None             # Time of the last command, to measure how long the Shelly takes to echo its status
+
+        # Buffers, allocated once and reused over the reconnections
+        self.y = np.zeros(seconds_to_reset * conversion * bufsize, np.int16)    # Continuous recording
+        self.z = np.zeros(clip_length(), np.int16)                              # Pre-roll + capture, handed to the queue
+        self.t = np.zeros(capture_blocks()[1] * bufsize, np.int16)              # Capture after the trigger
+        self.coalesced = 0          # Re-triggers merged into a capture
+        self.reset()
+
+    def reset(self):
+        # New connection, the capture state machine starts over
+        self.samp = False
+        self.i = 0
+        self.end = 0                # Blocks of the capture, moved on by a coalesced re-trigger
+        self.n = 0
+        self.triggered_at = 0.0
+        self.trigger_level = 0.0
+
+    def stats(self):
+        values = {}
+        for collector in (self.accounting.stats, self.aligner.stats, self.trigger.stats):
+            values.update(collector())
+        if self.admission is not None:
+            values.update(self.admission.stats())
+        if self.archive is not None:
+            values.update(self.archive.stats())
+        values["coalesced_triggers"] = self.coalesced
+        if len(device_list) > 1:
+            values = {name + '{device="' + self.name + '"}': value for name, value in values.items()}
+        return values
+
+
+def capture_blocks():
+    # Blocks of a capture after the trigger, and the most a coalesced one can grow to
+    listen = int(listening_for * conversion)
+    if overload_policy != "coalesce":
+        return listen, listen
+    return listen, max(int(coalesce_max * conversion), listen)
+
+
+def clip_length():
+    # Samples of the longest clip, pre-roll second included: the size of the pooled buffers
+    return (conversion + capture_blocks()[1]) * bufsize
+
+
+def create_devices():
+    # The boards of <devices>, or the single one of <source> / the ACM port
+    boards = devices or [{"name": "default", "port": source, "shelly_id": shelly_id}]
+    for k, board in enumerate(boards):
+        name = board.get("name", str(k))
+        if len(boards) > 1 and board.get("port") is None:
+            raise ValueError("Board " + name + " needs a port, only a single board can be searched")
+        device_list.append(Device(k, name, board.get("port"), board.get("shelly_id", shelly_id)))
+
+
+
+
 '''
     Receiver task (will run in its own executor)
 '''
-async def receiver(loop, serial_port_ACM):
+async def receiver(loop, device, serial_port_ACM, ready):
 
     global audio_queue
     global event 
     global stop
 
+    d = device      # State of this board, the other boards run their own receiver in the same loop
+
     # Serial COMM
     baudrate = 115200
 
-    # Signal processing variables
-    bufsize = 512   # It's the size of the numpy array 'x'
-    seconds_to_reset = 200
-    conversion = 32     # 32 conversion * 512 bufsize == 1 second at 16KHz of sample rate (almost)
-    N = seconds_to_reset * conversion * bufsize     # == [seconds] of recording (almost)
-    samp = False
-    i = 0
-    n = 0
-    listening_for = 1.5   # * conversion == [second/bufsize]
-    trigger_volume = 18000  # If the audio samples have magnitude greater than this start listening
-
-    # Preparing buffers
-    y = np.zeros(int(N), np.int16)
-    z = np.zeros(int((listening_for + 1) * conversion * bufsize), np.int16)
-    t = np.zeros(int(listening_for * conversion * bufsize), np.int16)
+    # Preparing buffers, allocated once by the Device
+    y, z, t = d.y, d.z, d.t
+    listen, longest = capture_blocks()
+    holdoff = int(coalesce_window * conversion) if overload_policy == "coalesce" else 0
+    d.reset()
     
+    replaying = replay.is_recording(serial_port_ACM)     # A recording instead of the microphone, same pipeline
+    connected = True
     try:
-        reader, writer = await serial_asyncio_fast.open_serial_connection(url=serial_port_ACM, baudrate=baudrate)
+        if replaying:
+            reader, writer = await replay.open_source(serial_port_ACM, fsamp, replay_speed)
+        else:
+            reader, writer = await serial_asyncio_fast.open_serial_connection(url=serial_port_ACM, baudrate=baudrate)
         print(writer.transport.get_extra_info("serial"))
+        d.accounting.start(None)    # Reference taken on the first block
     except:
-        print("Problem with serial connection")
+        print("Problem with serial connection " + d.name)
         writer = None
-        event.clear()
+        connected = False
         
 
-    while event.is_set() and not stop.is_set():
+    while connected and event.is_set() and not stop.is_set():
     
         deadline = loop.time() + 2    # Timeout of two seconds
         try:
@@ -90,103 +833,420 @@ async def receiver(loop, serial_port_ACM):
                 # the serial device, so it's already a waste of resources, with or without time.sleep(0.032),
                 # but still time.sleep() will ease the load on the CPU, because the transfer of data happend asynchronously in
                 # background, so waiting for enough data is always useful for my purposes.
-                time.sleep(0.032) 
+                # With more boards stopping the loop would delay all the others, there the loop sleeps in select() meanwhile.
+                if replaying: pass      # The recording paces itself
+                elif len(device_list) > 1: await asyncio.sleep(serial_pause)
+                else: loop_monitor.sleep(serial_pause)      # time.sleep(), accounted
                 data = await reader.readexactly(bufsize * 2)    # In order to read 512 samples of 16 bit each, I need 1024 bytes
+        except asyncio.IncompleteReadError:
+            print("End of the stream, closing...")
+            break
         except:
             print("Maybe a timeout, closing...")
             break
 
+        block_at = time.monotonic()     # Block arrival, start of the latency chain
+        d.accounting.block(len(data) // 2, block_at)
+
+        if d.aligner.check(data):
+            # Odd byte shift, drop one byte instead of waiting for a timeout and a full reconnect
+            print("Serial stream misaligned, dropping one byte")
+            try:
+                async with asyncio.timeout_at(loop.time() + 2):
+                    await reader.readexactly(1)
+            except:
+                print("Maybe a timeout, closing...")
+                break
+            continue        # This block is garbage, the next one is aligned
+
         # Data in input is buffered as 16bit, so 1024 bytes are coming at burst
         x = np.frombuffer(data, np.int16)
+        if d.archive is not None:
+            d.archive.append(x, time.time())    # A memcpy in the page cache, written to disk in batches
         # Continuous data recording
+        n = d.n
         y[n * bufsize: (n+1) * bufsize] = x
 
         '''
             Run to completion state machine, non blocking
         '''
-        if x.max(0) >= trigger_volume and not samp:
-            # Too loud, start listening for <listening_for>
-            samp = True
-
-        if samp == True: 
+        fired = d.trigger(x)
+        if fired and d.samp and overload_policy == "coalesce":
+            # Same speaker going on, during the capture or its hold-off: listen longer instead of a second utterance
+            d.end = min(d.i + listen, longest)
+            d.coalesced += 1
+        elif fired and not d.samp and (d.admission is None or d.admission.admit(block_at)):
+            # Too loud, and the board may still spend a request: start listening for <listening_for>
+            d.samp = True
+            d.end = listen
+            d.triggered_at = block_at
+            d.trigger_level = float(d.trigger.value)
+
+        if d.samp == True: 
             # Listen and collect data
-            if i < listening_for * conversion:
-                # Collect also the second before the activation
-                if i == 0:
-                    if n >= conversion: z[:bufsize * conversion] = y[(n - conversion) * bufsize: n * bufsize]
-                    else: z[:bufsize * conversion] = np.roll(y,conversion*bufsize,0)[n * bufsize: (n+conversion) * bufsize]
-                t[i * bufsize: (i+1) * bufsize] = x
-                i += 1
-
-            # Use >= to be sure to enter in this state
-            if i >= listening_for * conversion:
+            i = d.i
+            # Collect also the second before the activation
+            if i == 0:
+                if n >= conversion: z[:bufsize * conversion] = y[(n - conversion) * bufsize: n * bufsize]
+                else: z[:bufsize * conversion] = np.roll(y,conversion*bufsize,0)[n * bufsize: (n+conversion) * bufsize]
+            t[i * bufsize: (i+1) * bufsize] = x
+            i += 1
+
+            # Use >= to be sure to enter in this state. With "coalesce" keep recording the hold-off, a re-trigger there
+            # extends the capture over it, else the clip ends where the capture did
+            if i >= min(d.end + holdoff, longest):
                 # Send to speech recognizer thread and reset 
-                z[bufsize * conversion:] = t
-                samp = False
+                length = (conversion + d.end) * bufsize
+                z[bufsize * conversion: length] = t[:d.end * bufsize]
+                d.samp = False
                 i = 0
-                audio_queue.put(z)
+                if not audio_queue.put(z[:length], d.triggered_at, d.trigger_level, d.index):     # Copied in a pooled buffer, 'z' can be reused right away
+                    print("Recognizer busy, utterance dropped " + str(audio_queue.stats()))
+                elif d.admission is not None:
+                    d.admission.captured(d.triggered_at, d.triggered_at + deadline_budget)
+                ready.set()
+                metrics.observe("capture", time.monotonic() - d.triggered_at)
+            d.i = i
 
         if n < conversion * seconds_to_reset - 1:
-            n += 1
+            d.n = n + 1
         else:
-            n = 0
+            d.n = 0
+
+        metrics.observe("block_processing", time.monotonic() - block_at)
+
+    if d.archive is not None:
+        d.archive.flush()       # The next connection is a new run, don't leave its start unwritten
 
     if writer is not None:
         writer.transport.abort()    # Safe release of the serial communication port
         await asyncio.sleep(1)
     
     await asyncio.sleep(1)
-    print("Exiting coroutine")      # Stopping the loop
+    print("Exiting coroutine " + d.name)
 
   
 
 
 '''
-    Speech recognition thread
+    Speech recognition, shared by the worker threads and the in-loop tasks
 '''
-def recognize_worker():
+engine_KEY = "<Wit.Ai KEY>"     # Set the Wit.Ai key, you must register to their services
+matches_on = ["accend", "luc"]
+matches_off = ["spegn", "luc"]
+
+def command_for(voice):
+    if all(x in voice for x in matches_on): return "on"
+    if all(x in voice for x in matches_off): return "off"
+    return None
+
+
+def prepare_utterance(utterance, copy=False):
+    # Deadline and trimmed clip of the utterance, None if it's already too old to be worth sending
+    global metrics
+
+    metrics.observe("queue_wait", utterance.dequeued_at - utterance.captured_at)
+
+    deadline = utterance.triggered_at + deadline_budget
+    if utterance.dequeued_at >= deadline:
+        print("Utterance too old, dropped")
+        metrics.inc("deadline_abandoned")
+        return None
+
+    start, end = 0, utterance.samples.size
+    if trim:
+        start, end = trim_silence(utterance.samples, fsamp, trim_margin, trim_ratio, trim_min_rms)
+        metrics.inc("trim_clips")
+        metrics.inc("trim_bytes_saved", (utterance.samples.size - (end - start)) * 2)
+
+    clip = utterance.samples[start:end]
+    if copy:
+        clip = clip.copy()      # The losers of the race (or of the hedge) may still read it after the buffer is recycled
+    return deadline, clip
 
-    global mqttc
+
+def dispatch_command(utterance, voice):
+    # Publish the command heard in <voice> to the Shelly of the room, unless a newer capture there already switched
+    # the light. Returns the published one
+    global metrics
+
+    if voice == '': return None
+    payload = command_for(voice)
+    if payload is None: return None
+    device = device_list[utterance.device]
+    if device.sequencer.apply(utterance.seq, lambda: publish_command(payload, device)):
+        metrics.observe("trigger_to_publish", time.monotonic() - utterance.triggered_at)
+        return payload
+    print("Discarding '" + payload + "', a newer command was already sent")
+    return None
+
+
+def store_utterance(utterance, voice, command):
+    # Keep the whole clip (not the trimmed one) with its labels, the clip store copies it before the buffer is recycled
+    if clip_store is None: return
+    wall = time.time() - time.monotonic()       # Monotonic to wall clock offset
+    if not clip_store.put(utterance.samples, transcript=voice, command=command, device=device_list[utterance.device].name,
+                          trigger=trigger, trigger_level=utterance.trigger_level,
+                          triggered_at=utterance.triggered_at + wall, captured_at=utterance.captured_at + wall, seq=utterance.seq):
+        print("Clip store busy, clip not saved")
+
+
+def recognition_done(device, triggered_at, heard):
+    # Tell the admission control of the board how the recognition of its capture ended, see AdmissionControl.done()
+    board = device_list[device]
+    if board.admission is not None and board.admission.done(triggered_at, heard):
+        print("{0}: {1} triggers in a row without a command, trigger ignored for {2:g} s".format(board.name, admission_misses, admission_cooldown))
+
+
+'''
+    Speech recognition thread
+'''
+def recognize_worker(results=None):
+    # In a thread the commands are published from here, in a worker process (recognition_processes) they go back
+    # to the receiver process on <results>, see result_listener()
 
     # Audio variables
     global audio_queue
-    global shelly_id
-    fsamp = 16000
+    global fsamp
 
     # Speech recognition variable
     r = sr.Recognizer()
-    engine_KEY = "<Wit.Ai KEY>"     # Set the Wit.Ai key, you must register to their services
-    matches_on = ["accend", "luc"]
-    matches_off = ["spegn", "luc"]
+    if wit_api_url is not None: r.wit_api_url = wit_api_url
+    recognizers.append(r)
+    stamps = {}
+    r.timing_hook = lambda stage: stamps.__setitem__(stage, time.monotonic())   # Filled by recognize_wit()
+
+    WIT_AI_KEY = engine_KEY  # Wit.ai keys are 32-character uppercase alphanumeric strings
+    available = {"wit": lambda audio, deadline=None: r.recognize_wit(audio, key=WIT_AI_KEY, encoding=wit_encoding, convert_rate=wit_rate, deadline=deadline),
+                 "wit_new": lambda audio, deadline=None: r.recognize_wit_new(audio, key=WIT_AI_KEY, deadline=deadline),
+                 "vosk": lambda audio, deadline=None: r.recognize_vosk(audio, language="it")}
+    race = {name: available[name] for name in engines}
+
+    def done(utterance, heard):
+        if results is not None:
+            results.put(("done", utterance.device, utterance.triggered_at, heard))
+        else:
+            recognition_done(utterance.device, utterance.triggered_at, heard)
     
     print("Starting recognizer worker")
     
     while True:
-        audio_sample = audio_queue.get()
-        if audio_sample is None: break
+        utterance = audio_queue.get()
+        if utterance is None: break
+
+        stamps.clear()
+        prepared = prepare_utterance(utterance, copy=len(race) > 1 or hedge_quantile is not None)
+        if prepared is None:
+            done(utterance, None)
+            audio_queue.release(utterance)
+            continue
 
-        audio = sr.AudioData(audio_sample, fsamp, 2)  # retrieve the next audio processing job from the main thread
+        deadline, clip = prepared
+        audio = sr.NumpyAudioData(clip, fsamp)  # retrieve the next audio processing job from the main thread, no copy
         voice = ''
+        heard = None
         
-        # recognize speech using Wit.ai
-        WIT_AI_KEY = engine_KEY  # Wit.ai keys are 32-character uppercase alphanumeric strings
+        # recognize speech using Wit.ai (or race the engines, the first one hearing a command wins)
         try:
-            voice = str(r.recognize_wit(audio, key=WIT_AI_KEY)).lower()         
+            if len(race) == 1:
+                voice = str(r.recognize_hedged(audio, race[engines[0]], deadline=deadline, name=engines[0], hedge_quantile=hedge_quantile)).lower()
+            else:
+                _, voice = r.recognize_first(audio, {name: functools.partial(engine, deadline=deadline) for name, engine in race.items()},
+                                             predicate=lambda text: command_for(str(text).lower()) is not None, timeout=max(deadline - time.monotonic(), 0))
+                voice = str(voice).lower()
+        except (sr.DeadlineExceeded, sr.WaitTimeoutError):
+            print("No answer within the deadline, command abandoned")
+            metrics.inc("deadline_abandoned")
         except sr.UnknownValueError:
             print("Wit.ai could not understand audio")
+            heard = False
+            store_utterance(utterance, '', None)       # Negative example
         except sr.RequestError as e:
             print("Could not request results from Wit.ai service; {0}".format(e))
         except:
-            continue
+            pass
         else:
-            if voice != '':
-                if all(x in voice for x in matches_on): mqttc.publish(topic=shelly_id+"/command/switch:0", payload="on", qos=2)
-                elif all(x in voice for x in matches_off): mqttc.publish(topic=shelly_id+"/command/switch:0", payload="off", qos=2)
+            heard = command_for(voice) is not None
+            if results is not None:
+                results.put(("command", utterance.seq, utterance.device, utterance.triggered_at, utterance.captured_at, utterance.dequeued_at,
+                             voice, dict(stamps)))
+            else:
+                observe_recognition(utterance, stamps)
+                store_utterance(utterance, voice, dispatch_command(utterance, voice))
+        finally:
+            done(utterance, heard)
+            audio_queue.release(utterance)      # Recycle the buffer for the next trigger
 
     print("Exiting recognizer worker")
 
 
 
+'''
+    Speech recognition processes (recognition_processes > 0)
+'''
+class RemoteMetrics:
+    # Stands in for the metrics inside a worker process, the values travel back to the receiver on the results queue
+
+    def __init__(self, results):
+        self.results = results
+
+    def observe(self, name, seconds):
+        self.results.put(("observe", name, seconds))
+
+    def inc(self, name, value=1):
+        self.results.put(("inc", name, value))
+
+
+def recognize_process(ring, results):
+    # Worker process: the same worker loop, reading the clips from the shared memory ring
+    global audio_queue
+    global metrics
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)     # The receiver handles the exit and closes the ring
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    audio_queue = ring
+    metrics = RemoteMetrics(results)
+    recognize_worker(results)
+
+
+def result_listener(results):
+    # Receiver process: publish the commands heard by the worker processes, apply their metrics
+    while True:
+        item = results.get()
+        if item is None: break
+        if item[0] == "observe":
+            metrics.observe(item[1], item[2])
+        elif item[0] == "inc":
+            metrics.inc(item[1], item[2])
+        elif item[0] == "done":
+            recognition_done(item[1], item[2], item[3])
+        else:
+            _, seq, device, triggered_at, captured_at, dequeued_at, voice, stamps = item
+            utterance = Utterance(None, None)       # Only the timestamps, the board and the sequence number, the clip is already released
+            utterance.seq, utterance.device = seq, device
+            utterance.triggered_at, utterance.captured_at, utterance.dequeued_at = triggered_at, captured_at, dequeued_at
+            observe_recognition(utterance, stamps)
+            dispatch_command(utterance, voice)
+
+
+
+'''
+    Speech recognition tasks, inside the event loop (async_recognition = True)
+'''
+task_stamps = contextvars.ContextVar("task_stamps")     # Every task runs in its own context, so its own stamps
+
+async def recognize_dispatcher(ready):
+    # Same job as the worker threads without the threads: at most <recognition_workers> requests in flight
+    global audio_queue
+
+    r = sr.Recognizer()
+    if wit_api_url is not None: r.wit_api_url = wit_api_url
+    recognizers.append(r)
+    r.timing_hook = lambda stage: task_stamps.get().__setitem__(stage, time.monotonic())
+    tasks = set()
+
+    def done(task):
+        tasks.discard(task)
+        ready.set()         # A slot is free, look at the queue again
+
+    print("Starting recognizer tasks")
+    try:
+        while True:
+            await ready.wait()      # Set by the receiver after every put()
+            ready.clear()
+            while len(tasks) < recognition_workers:
+                utterance = audio_queue.get_nowait()
+                if utterance is None: break
+                task = asyncio.ensure_future(recognize_task(r, utterance))
+                tasks.add(task)
+                task.add_done_callback(done)
+            if audio_queue.closed and not tasks and audio_queue.stats()["queued"] == 0:
+                break       # Closed and drained
+    finally:
+        for task in list(tasks):
+            task.cancel()       # Releases the buffers and aborts the requests
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await r.aclose()
+        recognizers.remove(r)
+        print("Exiting recognizer tasks")
+
+
+async def recognize_task(r, utterance):
+    stamps = {}
+    task_stamps.set(stamps)
+    heard = None
+    try:
+        prepared = prepare_utterance(utterance)     # No copy, the buffer is released only when the task ends
+        if prepared is None: return
+
+        deadline, clip = prepared
+        audio = sr.NumpyAudioData(clip, fsamp)
+        try:
+            if engines[0] == "wit_new":
+                voice = await r.recognize_wit_new_async(audio, key=engine_KEY, deadline=deadline)
+            else:
+                voice = await r.recognize_wit_async(audio, key=engine_KEY, encoding=wit_encoding, convert_rate=wit_rate, deadline=deadline)
+            voice = str(voice).lower()
+        except sr.DeadlineExceeded:
+            print("No answer within the deadline, command abandoned")
+            metrics.inc("deadline_abandoned")
+        except sr.UnknownValueError:
+            print("Wit.ai could not understand audio")
+            heard = False
+            store_utterance(utterance, '', None)       # Negative example
+        except sr.RequestError as e:
+            print("Could not request results from Wit.ai service; {0}".format(e))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            pass
+        else:
+            heard = command_for(voice) is not None
+            observe_recognition(utterance, stamps)
+            store_utterance(utterance, voice, dispatch_command(utterance, voice))
+    finally:
+        recognition_done(utterance.device, utterance.triggered_at, heard)
+        audio_queue.release(utterance)      # Recycle the buffer for the next trigger
+
+
+
+def observe_recognition(utterance, stamps):
+    # Split the Wit.ai round-trip in stages, missing stamps mean the engine doesn't report them
+    global metrics
+    start = utterance.dequeued_at
+    for name, begin, end in (("wav_encode", None, "wav_encoded"), ("upload_first_byte", "request_sent", "first_byte"),
+                             ("download", "first_byte", "completed")):
+        if end in stamps and (begin is None or begin in stamps):
+            metrics.observe(name, stamps[end] - (start if begin is None else stamps[begin]))
+    metrics.observe("recognition", time.monotonic() - start)
+
+
+def publish_command(payload, device):
+    global mqttc
+    global metrics
+
+    start = time.monotonic()
+    mqttc.publish(topic=device.shelly_id+"/command/switch:0", payload=payload, qos=2)
+    device.last_publish_at = time.monotonic()
+    metrics.observe("mqtt_publish", device.last_publish_at - start)
+
+
+
+def engines_stats():
+    # Wins, runs and mean latency of the raced engines, hedged requests, summed over the workers
+    values = {}
+    for r in recognizers:
+        for name, stats in list(r.race_stats.items()):
+            for key in ("runs", "wins", "errors"):
+                values["engine_" + name + "_" + key] = values.get("engine_" + name + "_" + key, 0) + stats[key]
+            values["engine_" + name + "_latency_seconds_total"] = values.get("engine_" + name + "_latency_seconds_total", 0.0) + stats["latency"]
+        for name, stats in list(r.hedge_stats.items()):
+            for key, value in stats.items():
+                values["hedge_" + name + "_" + key] = values.get("hedge_" + name + "_" + key, 0) + value
+    return values
+
+
+
 '''
     Find serial port where PDM MIC is attached (look here for alternative https://github.com/pyserial/pyserial/pull/658/files)
 '''
@@ -224,8 +1284,9 @@ def ask_exit():
     global stop
     global mqttc
 
+    loop_monitor.detach()   # The sleep below blocks the loop on purpose, it's not a stall
     event.clear()           # Stop coroutine
-    audio_queue.put(None)   # Stop the recognizer worker
+    audio_queue.close()     # Stop the recognizer worker
     stop.set()              # Gracefully stop the loop and all other asyncio task in background
     time.sleep(1)
     mqttc.disconnect()      # Stop the MQTT loop on the other thread
@@ -240,7 +1301,7 @@ def ask_exit_win(a,b):
     global mqttc
 
     event.clear()           # Stop coroutine
-    audio_queue.put(None)   # Stop the recognizer worker
+    audio_queue.close()     # Stop the recognizer worker
     stop.set()              # Gracefully stop the loop and all other asyncio task in background
     time.sleep(1)
     mqttc.disconnect()      # Stop the MQTT loop on the other thread
@@ -257,14 +1318,13 @@ def ask_exit_win(a,b):
 # MQTT init
 def mqttc_init():
     global mqttc
-    broker_url = "localhost"    # Default, you can change it to the IP address your broker
-    global shelly_id
     
     mqttc.on_message = on_message
     mqttc.on_connect = on_connect
     mqttc.on_subscribe = on_subscribe
-    mqttc.connect(broker_url)   # Blocking call, default port 1883
-    mqttc.subscribe(topic=shelly_id+"/status/switch:0", qos=2)
+    mqttc.connect(mqtt_broker, mqtt_port)   # Blocking call
+    for shelly in sorted(set(device.shelly_id for device in device_list)):
+        mqttc.subscribe(topic=shelly+"/status/switch:0", qos=2)     # One client for every room
     mqttc.loop_start()  # It won't block, the loop is on another thread (the 3rd!)
 
 
@@ -273,6 +1333,10 @@ def on_connect(mqttc, obj, flags, reason_code, properties):
     print("reason_code: " + str(reason_code))
 
 def on_message(mqttc, obj, msg):
+    for device in device_list:
+        if device.last_publish_at is not None and msg.topic == device.shelly_id + "/status/switch:0":
+            metrics.observe("switch_echo", time.monotonic() - device.last_publish_at)
+            device.last_publish_at = None
     print(msg.topic + " " + str(msg.qos) + " " + str(msg.payload))
 
 def on_subscribe(mqttc, obj, mid, reason_code_list, properties):
@@ -288,10 +1352,28 @@ def on_log(mqttc, obj, level, string):
     Speech_recognition thread init
 '''
 def rec_worker_init():
-    # Start a new thread to recognize audio, while this thread focuses on listening
-    recognize_thread = Thread(target=recognize_worker)
-    recognize_thread.daemon = True
-    recognize_thread.start()
+    # Start <recognition_workers> threads to recognize audio, while this thread focuses on listening.
+    # Wit.ai requests are IO-bound, so the threads wait on the network and not on the GIL.
+    if async_recognition:
+        return      # The receiver runs them as tasks of its own loop, see recognize_dispatcher()
+    if recognition_processes:
+        # Forked before any other thread starts, the workers inherit the settings and the shared block
+        ctx = multiprocessing.get_context("fork" if os.name == "posix" else "spawn")
+        results = ctx.Queue()
+        for _ in range(recognition_processes):
+            process = ctx.Process(target=recognize_process, args=(audio_queue, results))
+            process.daemon = True
+            process.start()
+            workers.append(process)
+        listener = Thread(target=result_listener, args=(results,))
+        listener.daemon = True
+        listener.start()
+        return
+    for _ in range(recognition_workers):
+        recognize_thread = Thread(target=recognize_worker)
+        recognize_thread.daemon = True
+        recognize_thread.start()
+        workers.append(recognize_thread)
     
 
 
@@ -299,25 +1381,62 @@ def rec_worker_init():
 '''
     Main loop
 '''
-def loop():
-    global event
-    global audio_queue
-    global stop
-    
-    while True:
-
-        event.set()
-        
-        serial_port = ''
+def find_port(device):
+    # Blocking (opens every tty, runs fuser), called in an executor so the other boards keep streaming
+    serial_port = ''
+    if device.port is not None:
+        serial_port = device.port       # Recording or given port, don't kill whoever is feeding it
+    else:
         for serial_port_name in serial_ports():
             if "ACM" in serial_port_name:
                 serial_port = serial_port_name
             elif "COM7" in serial_port_name:        # On Windows you must give the correct port where to look
                 serial_port = serial_port_name
-        
         if os.name == "posix": 
             subprocess.run(["fuser", "-k", serial_port])    # Kill process that are using the MIC, if any
-        time.sleep(1)   # Give the OS time to start other services
+    time.sleep(1)   # Give the OS time to start other services
+    return serial_port
+
+
+async def supervise(loop, device, ready):
+    # Connect, receive and reconnect one board, a failing board doesn't touch the others
+    while event.is_set() and not stop.is_set():
+        serial_port = await loop.run_in_executor(None, find_port, device)
+        await receiver(loop, device, serial_port, ready)
+        if replay.is_recording(serial_port):
+            break                       # End of the recording
+        audio_queue.clear(device.index)     # Empty the queue to restart listening wihtout interfering with old samples
+        await asyncio.sleep(2)
+
+
+async def serve(loop):
+    # All the boards in this loop, with the in-loop recognition woken up at every queued utterance
+    ready = asyncio.Event()
+    dispatcher = asyncio.ensure_future(recognize_dispatcher(ready)) if async_recognition else None
+
+    await asyncio.gather(*(supervise(loop, device, ready) for device in device_list))
+
+    if dispatcher is not None:
+        if all(replay.is_recording(device.port) for device in device_list):
+            # End of the recordings, recognize what was captured before leaving
+            audio_queue.close()
+            ready.set()
+            try:
+                await asyncio.wait_for(dispatcher, deadline_budget + 1)
+            except asyncio.TimeoutError:
+                pass
+        else:
+            dispatcher.cancel()     # Abandon the requests in flight, the service is stopping
+        await asyncio.gather(dispatcher, return_exceptions=True)
+
+
+def loop():
+    global event
+    global stop
+    
+    while True:
+
+        event.set()
         
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
@@ -326,17 +1445,19 @@ def loop():
             for sig in (signal.SIGINT, signal.SIGTERM):
                 loop.add_signal_handler(sig, ask_exit)      # Handle external signal, also SIGTERM from OS
         
+        loop_monitor.attach(loop)
         try:
-            loop.run_until_complete(receiver(loop, serial_port))
+            loop.run_until_complete(serve(loop))
         except:
             pass
+        loop_monitor.detach()       # Restarting, not a stall
 
         if os.name == "posix":
             for sig in (signal.SIGINT, signal.SIGTERM):
                 loop.remove_signal_handler(sig)
 
-        while not audio_queue.empty():
-            audio_queue.get()           # Empty the queue to restart listening wihtout interfering with old samples
+        if all(replay.is_recording(device.port) for device in device_list):
+            stop.set()                  # End of the recordings, main() lets the recognizers finish the queue
 
         time.sleep(2)
         loop.close()
@@ -349,14 +1470,69 @@ def loop():
 
 def main():
     global stop
+    global audio_queue
+    global archive
+    global clip_store
     stop.clear()
     
-    mqttc_init()
+    if recognition_processes and async_recognition:
+        # The in-loop tasks read the queue of the receiver process, the worker processes read the shared ring
+        raise ValueError("async_recognition and recognition_processes can't be used together, choose one")
+    if recognition_processes and clip_store_dir is not None:
+        # The clips are recognized in the worker processes, the store would never see one
+        raise ValueError("clip_store_dir needs the threaded recognizers, set recognition_processes = 0")
+    create_devices()        # Before the worker processes fork, they need the boards too
+    if recognition_processes:
+        audio_queue = SharedUtteranceRing(queue_size + recognition_processes, clip_length(), consumers=recognition_processes)
+    else:
+        audio_queue = UtteranceQueue(queue_size, clip_length(), in_flight=recognition_workers, policy=overload_policy)
     rec_worker_init()
+    metrics.add_collector(lambda: {"audio_queue_" + k: v for k, v in audio_queue.stats().items()})
+    metrics.add_collector(engines_stats)
+    metrics.add_collector(loop_monitor.stats)
+    for device in device_list:
+        if archive_dir is not None:
+            device.archive = AudioArchive(archive_dir if len(device_list) == 1 else os.path.join(archive_dir, device.name),
+                                          fsamp, archive_segment_seconds, archive_max_bytes, archive_max_age)
+        metrics.add_collector(device.stats)
+    archive = device_list[0].archive
+    if clip_store_dir is not None:
+        clip_store = ClipStore(clip_store_dir)
+        metrics.add_collector(clip_store.stats)
+    if metrics_port is not None:
+        metrics.serve(metrics_port)
+    metrics.start_summary(metrics_summary_interval)
+    loop_monitor.interval = monitor_interval
+    loop_monitor.threshold = monitor_threshold
+    loop_monitor.start()
+    mqttc_init()
     if os.name == "nt":
         signal.signal(signal.SIGINT, ask_exit_win)
         signal.signal(signal.SIGTERM, ask_exit_win)
+    else:
+        # Process wide, unlike the loop handlers they stay installed while the serial reconnects
+        profiler.directory = profile_dir
+        profiler.interval = profile_interval
+        profiler.handle_signals(signal.SIGUSR1, signal.SIGUSR2)     # Started, stopped and written off the loop
     loop()
+    profiler.stop()
+    loop_monitor.stop()
+    if all(replay.is_recording(device.port) for device in device_list):
+        audio_queue.close()
+        for worker in workers:
+            worker.join(deadline_budget + 1)    # Recognize the last captured clips, then leave
+        mqttc.disconnect()
+        mqttc.loop_stop()
+    if recognition_processes:
+        audio_queue.close()
+        for worker in workers:
+            worker.join(deadline_budget + 1)
+        audio_queue.unlink()        # Free the block in /dev/shm
+    for device in device_list:
+        if device.archive is not None:
+            device.archive.close()
+    if clip_store is not None:
+        clip_store.close()      # Writes the last partial shard
 
 
 if __name__ == "__main__":
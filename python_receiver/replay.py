@@ -0,0 +1,144 @@
+'''
+    Offline audio sources for the receiver, to run the whole pipeline without the Arduino.
+
+    FileSource stands in for the (reader, writer) pair of serial_asyncio_fast: it serves a WAV (16 bit mono) or a raw
+    int16 ".bin" recording (like test_golang/raw_wav.bin) through readexactly(), paced at <speed> times real time,
+    or as fast as the receiver can take it with speed = 0.
+
+    feed_pty() goes one step further and plays the recording on a pseudo-terminal, so the receiver opens it as a real
+    serial port: "python replay.py microphone-results.wav" prints the /dev/pts path to give to the receiver.
+'''
+
+import argparse
+import asyncio
+import os
+import threading
+import time
+import wave
+
+import numpy as np
+
+
+def load_samples(path, fsamp=16000):
+    # int16 samples of a WAV or raw recording, the rate must match the receiver
+    if path.endswith(".wav"):
+        with wave.open(path, "rb") as w:
+            if w.getsampwidth() != 2 or w.getnchannels() != 1:
+                raise ValueError(path + " must be 16 bit mono")
+            if w.getframerate() != fsamp:
+                raise ValueError("{0} is at {1} Hz, the receiver expects {2} Hz".format(path, w.getframerate(), fsamp))
+            return np.frombuffer(w.readframes(w.getnframes()), np.int16)
+    return np.fromfile(path, np.int16)
+
+
+class FileSource:
+    # Duck-types the StreamReader and the StreamWriter (only transport.abort() and get_extra_info() are used)
+
+    def __init__(self, path, fsamp=16000, speed=1.0, repeat=False):
+        self.path = path
+        self.data = load_samples(path, fsamp).tobytes()
+        self.fsamp = fsamp
+        self.speed = speed          # 1.0 real time, 0 as fast as possible
+        self.repeat = repeat
+        self.position = 0
+        self.closed = False
+        self._start = None
+        self.transport = self
+
+    async def readexactly(self, n):
+        if self.closed:
+            raise asyncio.IncompleteReadError(b"", n)
+        if self.position + n > len(self.data):
+            if not self.repeat:
+                partial = self.data[self.position:]
+                self.position = len(self.data)
+                raise asyncio.IncompleteReadError(partial, n)       # End of the recording, like an unplugged device
+            self.position = 0
+            self._start = None
+        if self._start is None:
+            self._start = time.monotonic() - self.position / 2 / self.fsamp / self.speed if self.speed else 0.0
+        chunk = self.data[self.position:self.position + n]
+        self.position += n
+        if self.speed:
+            # The block is ready when the microphone would have produced its last sample
+            delay = self._start + self.position / 2 / self.fsamp / self.speed - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        else:
+            await asyncio.sleep(0)      # Still let the other tasks run
+        return chunk
+
+    def abort(self):
+        self.closed = True
+
+    def get_extra_info(self, name, default=None):
+        return "FileSource({0}, speed={1})".format(self.path, self.speed) if name == "serial" else default
+
+
+async def open_source(url, fsamp=16000, speed=1.0, repeat=False):
+    # Same signature and result as serial_asyncio_fast.open_serial_connection() for a recording
+    source = FileSource(url, fsamp, speed, repeat)
+    return source, source
+
+
+def is_recording(url):
+    return url is not None and url.endswith((".wav", ".bin", ".raw")) and os.path.isfile(url)
+
+
+def feed_pty(path, fsamp=16000, speed=1.0, block=1024, repeat=False, start=None, linger=1.0, silence=False):
+    # Plays the recording on the master side of a new pty in <block> bytes bursts, like the firmware does,
+    # returns the slave path and the feeding thread ("sent" counts the bytes written, set "stop" to end early). With a <start>
+    # Event it waits for it before playing (the pty buffer is only a few KB, the pacing would be lost while nobody
+    # reads), and it hangs up <linger> seconds after the end, streaming zeros meanwhile with <silence> like a quiet room.
+    import tty
+
+    data = load_samples(path, fsamp).tobytes()
+    master, slave = os.openpty()
+    tty.setraw(slave)           # No line discipline, the bytes go through untouched
+    name = os.ttyname(slave)
+
+    def write(chunk, began):
+        os.write(master, chunk)
+        thread.sent += len(chunk)
+        if speed:
+            delay = began + thread.sent / 2 / fsamp / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+    def feeder():
+        if start is not None:
+            start.wait()
+        began = time.monotonic()
+        while True:
+            for k in range(0, len(data) - block + 1, block):
+                write(data[k:k + block], began)
+            if not repeat:
+                break
+        end = time.monotonic() + linger     # Let the reader drain the pty before hanging up
+        zeros = bytes(block)
+        while silence and time.monotonic() < end and not thread.stop.is_set():
+            write(zeros, began)
+        thread.stop.wait(max(end - time.monotonic(), 0))
+        os.close(master)
+
+    thread = threading.Thread(target=feeder)
+    thread.sent = 0
+    thread.stop = threading.Event()
+    thread.daemon = True
+    thread.start()
+    return name, thread
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Play a recording on a pty, as if it was the PDM microphone")
+    parser.add_argument("path", help="WAV (16 bit mono 16 kHz) or raw int16 .bin recording")
+    parser.add_argument("--speed", type=float, default=1.0, help="times real time, 0 for as fast as possible")
+    parser.add_argument("--repeat", action="store_true", help="loop the recording forever")
+    args = parser.parse_args()
+
+    name, thread = feed_pty(args.path, speed=args.speed, repeat=args.repeat)
+    print("Playing " + args.path + " on " + name + ", set source = \"" + name + "\" in recognizer.py")
+    try:
+        thread.join()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,147 @@
+'''
+    Utterance handoff to worker processes through shared memory.
+
+    The clips live in one multiprocessing.shared_memory block of <slots> rows, allocated once. put() copies the clip
+    in a free row and sends only a small descriptor (slot, length, sequence number, timestamps) on a queue, the worker
+    reads the row as a NumPy view (no pickling, no copy) and gives the slot back with release().
+
+    Same interface as UtteranceQueue in recognizer.py, so receiver() and recognize_worker() don't change. The overload
+    policy is always "drop-newest": a clip with no free slot is dropped, the ones already queued are never touched.
+'''
+
+import multiprocessing
+import queue
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+class SharedUtterance:
+    # Same fields as recognizer.Utterance, <samples> is a view on the shared row
+    __slots__ = ("slot", "samples", "captured_at", "seq", "triggered_at", "trigger_level", "device", "dequeued_at")
+
+    def __init__(self, slot, samples, seq, captured_at, triggered_at, trigger_level, device):
+        self.slot = slot
+        self.samples = samples
+        self.seq = seq
+        self.captured_at = captured_at
+        self.triggered_at = triggered_at        # time.monotonic() is system wide, comparable between the processes
+        self.trigger_level = trigger_level
+        self.device = device
+        self.dequeued_at = 0.0
+
+
+class SharedUtteranceRing:
+
+    def __init__(self, slots, clip_samples, consumers=1, ctx=None):
+        ctx = multiprocessing.get_context() if ctx is None else ctx
+        self.slots = slots
+        self.clip_samples = clip_samples
+        self.consumers = consumers      # One stop sentinel each at close()
+        self._shm = shared_memory.SharedMemory(create=True, size=slots * clip_samples * 2)
+        self._owner = True
+        self._pool = np.ndarray((slots, clip_samples), np.int16, buffer=self._shm.buf)
+        self._free = ctx.Queue()
+        for k in range(slots):
+            self._free.put(k)
+        # Counts the slots in _free. A put() on a multiprocessing queue reaches the reader later, through a feeder
+        # thread, so get_nowait() can find it empty while slots are free: the semaphore decides, get() then waits
+        # the few microseconds the index needs to arrive
+        self._available = ctx.Semaphore(slots)
+        self._ready = ctx.Queue()       # Descriptors, a few dozen bytes pickled
+        self._closed = False
+        self._next_seq = 0
+
+        # Counters, in the receiver process
+        self.enqueued = 0
+        self.dropped_newest = 0
+
+    def __getstate__(self):
+        # Only the name of the block travels to a spawned worker, it maps the same memory again
+        state = self.__dict__.copy()
+        del state["_pool"]
+        state["_owner"] = False
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._pool = np.ndarray((self.slots, self.clip_samples), np.int16, buffer=self._shm.buf)
+
+    def put(self, clip, triggered_at=None, trigger_level=0.0, device=0):
+        # Called from the asyncio loop, never blocks
+        if self._closed:
+            return False
+        if not self._available.acquire(False):
+            self.dropped_newest += 1
+            return False
+        slot = self._free.get()
+        now = time.monotonic()
+        self._pool[slot, :clip.size] = clip
+        self._next_seq += 1
+        self._ready.put((slot, clip.size, self._next_seq, now, now if triggered_at is None else triggered_at, trigger_level, device))
+        self.enqueued += 1
+        return True
+
+    def get(self):
+        # Blocking, in the worker process, None once the ring is closed
+        descriptor = self._ready.get()
+        if descriptor is None:
+            return None
+        slot, length, seq, captured_at, triggered_at, trigger_level, device = descriptor
+        utt = SharedUtterance(slot, self._pool[slot, :length], seq, captured_at, triggered_at, trigger_level, device)
+        utt.dequeued_at = time.monotonic()
+        return utt
+
+    def release(self, utt):
+        self._free.put(utt.slot)
+        self._available.release()       # After the put, so an acquired slot is always on its way
+
+    def clear(self, device=None):
+        # Drop the waiting clips (of one board only), in the receiver process
+        kept = []
+        sentinel = False
+        while True:
+            try:
+                descriptor = self._ready.get_nowait()
+            except queue.Empty:
+                break
+            if descriptor is None:
+                sentinel = True             # A stop sentinel, leave it for the workers
+                break
+            if device is None or descriptor[6] == device:
+                self._free.put(descriptor[0])
+                self._available.release()
+            else:
+                kept.append(descriptor)     # The other boards' clips go back, in their order
+        for descriptor in kept:
+            self._ready.put(descriptor)
+        if sentinel:
+            self._ready.put(None)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        for _ in range(self.consumers):
+            self._ready.put(None)
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def unlink(self):
+        # Free the shared block, by the receiver once the workers are gone
+        self._pool = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+    def stats(self):
+        # qsize() is approximate and not available on macOS
+        try:
+            queued, free = self._ready.qsize(), self._free.qsize()
+        except NotImplementedError:
+            queued, free = -1, -1
+        return {"queued": queued, "free": free, "enqueued": self.enqueued, "dropped_oldest": 0,
+                "dropped_newest": self.dropped_newest}
@@ -5,15 +5,18 @@
 from __future__ import annotations
 
 import aifc
+import asyncio
 import audioop
 import base64
 import collections
+import concurrent.futures
 import hashlib
 import hmac
 import io
 import json
 import math
 import os
+import socket
 import subprocess
 import sys
 import tempfile
@@ -41,6 +44,10 @@ from .exceptions import (
     WaitTimeoutError,
 )
 
+class DeadlineExceeded(RequestError):
+    """Raised when a request can't complete before the caller's deadline; it's a ``RequestError``, so existing handlers still catch it."""
+
+
 __author__ = "Anthony Zhang (Uberi)"
 __version__ = "3.10.3"
 __license__ = "BSD"
@@ -339,6 +346,15 @@ class Recognizer(AudioSource):
 
         self.phrase_threshold = 0.3  # minimum seconds of speaking audio before we consider the speaking audio a phrase - values below this are ignored (for filtering out clicks and pops)
         self.non_speaking_duration = 0.5  # seconds of non-speaking audio to keep on both sides of the recording
+        self.timing_hook = None  # callable invoked with the stage name ("wav_encoded", "request_sent", "first_byte", "completed") during Wit.ai requests, or ``None``
+        self.wit_api_url = "https://api.wit.ai"  # base URL of the Wit.ai API, can point to a local stand-in server for tests and benchmarks
+        self.connect_timeout = 1.5  # seconds allowed to establish the connection of a Wit.ai request when a deadline is given, the read timeout gets the rest of the budget
+        self.race_stats = {}  # per-engine runs, wins, errors and total latency of ``recognize_first``
+        self.hedge_latencies = {}  # recent latencies of ``recognize_hedged`` per engine name, to pick when to hedge
+        self.hedge_stats = {}  # per-engine requests, hedges, hedge wins and abandoned requests of ``recognize_hedged``
+        self._session = None  # aiohttp session of the ``*_async`` recognizers, bound to an event loop
+        self._session_loop = None
+        self._race_executor = None
 
     def record(self, source, duration=None, offset=None):
         """
@@ -744,7 +760,7 @@ class Recognizer(AudioSource):
             transcript += result.alternatives[0].transcript.strip() + ' '
         return transcript
 
-    def recognize_wit(self, audio_data, key, show_all=False):
+    def recognize_wit(self, audio_data, key, show_all=False, encoding="wav", convert_rate=None, deadline=None):
         """
         Performs speech recognition on ``audio_data`` (an ``AudioData`` instance), using the Wit.ai API.
 
@@ -754,6 +770,10 @@ class Recognizer(AudioSource):
 
         The recognition language is configured in the Wit.ai app settings.
 
+        The upload payload is selected by ``encoding``: ``"wav"`` (the default, 16-bit WAV), ``"raw"`` (headerless 16-bit PCM), ``"mulaw"`` (8-bit G.711 mu-law, half the bytes) or ``"flac"`` (lossless, encoded in-process; Wit.ai doesn't document FLAC, so use it with endpoints that accept it). ``convert_rate`` resamples the audio before encoding, for example ``8000`` halves the payload of a 16 kHz recording. See ``encode_audio``.
+
+        If ``deadline`` (a ``time.monotonic()`` value) is given, the connect and read timeouts are derived from the remaining budget, and a ``speech_recognition.DeadlineExceeded`` exception is raised when it runs out.
+
         Returns the most likely transcription if ``show_all`` is false (the default). Otherwise, returns the `raw API response <https://wit.ai/docs/http/20141022#get-intent-via-text-link>`__ as a JSON dictionary.
 
         Raises a ``speech_recognition.UnknownValueError`` exception if the speech is unintelligible. Raises a ``speech_recognition.RequestError`` exception if the speech recognition operation failed, if the key isn't valid, or if there is no internet connection.
@@ -761,19 +781,25 @@ class Recognizer(AudioSource):
         assert isinstance(audio_data, AudioData), "Data must be audio data"
         assert isinstance(key, str), "``key`` must be a string"
 
-        wav_data = audio_data.get_wav_data(
-            convert_rate=None if audio_data.sample_rate >= 8000 else 8000,  # audio samples must be at least 8 kHz
-            convert_width=2  # audio samples should be 16-bit
-        )
-        url = "https://api.wit.ai/speech?v=20210926"
-        request = Request(url, data=wav_data, headers={"Authorization": "Bearer {}".format(key), "Content-Type": "audio/wav"})
+        payload, content_type = self._wit_payload(audio_data, encoding, convert_rate)
+        self._timing("wav_encoded")
+        url = self.wit_api_url + "/speech?v=20210926"
+        request = Request(url, data=payload, headers={"Authorization": "Bearer {}".format(key), "Content-Type": content_type})
+        _, read_timeout = self._request_timeouts(deadline)
+        self._timing("request_sent")
         try:
-            response = urlopen(request, timeout=self.operation_timeout)
+            # urlopen has a single timeout for the connection and every read, give it the whole remaining budget
+            response = urlopen(request, timeout=read_timeout)
+            self._timing("first_byte")
+            response_text = response.read().decode("utf-8")
         except HTTPError as e:
             raise RequestError("recognition request failed: {}".format(e.reason))
         except URLError as e:
+            if isinstance(e.reason, socket.timeout): raise self._timeout_error(deadline, "recognition connection timed out")
             raise RequestError("recognition connection failed: {}".format(e.reason))
-        response_text = response.read().decode("utf-8")
+        except (socket.timeout, TimeoutError):
+            raise self._timeout_error(deadline, "recognition response timed out")
+        self._timing("completed")
         result = json.loads(response_text)
 
         # return results
@@ -781,7 +807,7 @@ class Recognizer(AudioSource):
         if "text" not in result or result["text"] is None: raise UnknownValueError()
         return result["text"]
 
-    def recognize_wit_new(self, audio_data, key, show_all=False, api="dictation"):
+    def recognize_wit_new(self, audio_data, key, show_all=False, api="dictation", deadline=None):
             """
             Performs speech recognition on ``audio_data`` (an ``AudioData`` instance), using the Wit.ai API.
     
@@ -791,6 +817,8 @@ class Recognizer(AudioSource):
     
             The recognition language is configured in the Wit.ai app settings.
     
+            If ``deadline`` (a ``time.monotonic()`` value) is given, the connect and read timeouts are derived from the remaining budget, and a ``speech_recognition.DeadlineExceeded`` exception is raised when it runs out.
+    
             Returns the most likely transcription if ``show_all`` is false (the default). Otherwise, returns the `raw API response <https://wit.ai/docs/http/20141022#get-intent-via-text-link>`__ as a JSON dictionary.
     
             Raises a ``speech_recognition.UnknownValueError`` exception if the speech is unintelligible. Raises a ``speech_recognition.RequestError`` exception if the speech recognition operation failed, if the key isn't valid, or if there is no internet connection.
@@ -805,7 +833,8 @@ class Recognizer(AudioSource):
                 convert_width=2  # audio samples should be 16-bit
             )
             
-            url = "https://api.wit.ai/" + api
+            self._timing("wav_encoded")
+            url = self.wit_api_url + "/" + api
             '''
             #request = Request(url, data=wav_data, headers={"Authorization": "Bearer {}".format(key), "Content-Type": "audio/wav"})
             try:
@@ -821,24 +850,306 @@ class Recognizer(AudioSource):
             results = json.loads(concat_json_str)
             '''
 
+            connect_timeout, read_timeout = self._request_timeouts(deadline)
+            self._timing("request_sent")
+            response = None
+            complete = False
+            results = []
             try: 
-                response = urllib3.request("POST", url=url, body=wav_data, headers={"Authorization": "Bearer {}".format(key), "Content-Type": "audio/wav"})
-            except:
-                raise RequestError("recognition request failed")
-            
-            d = re.sub("\n}\r\n{\n", "\n},\n{\n", response.data.decode())
-            results = json.loads(f"[{d}]")
+                # No automatic retries, with a deadline a duplicate request is the caller's choice (see recognize_hedged)
+                response = urllib3.request("POST", url=url, body=wav_data, headers={"Authorization": "Bearer {}".format(key), "Content-Type": "audio/wav"},
+                                           preload_content=False, retries=False, timeout=urllib3.Timeout(connect=connect_timeout, read=read_timeout))
+                self._timing("first_byte")
+                if response.status >= 400:
+                    raise RequestError("recognition request failed: HTTP {} {}".format(response.status, response.reason))
+
+                # The body is a stream of JSON objects (partial transcriptions, then the final one): decode them as
+                # they arrive and answer as soon as the final transcription is there, without waiting for the end
+                for result in iter_json_objects(response.stream(1024)):
+                    if show_all:
+                        results.append(result)
+                        continue
+                    if "code" in result and result["code"] == "bad-request": raise RequestError("recognition request failed")
+                    if result.get("type") == "FINAL_TRANSCRIPTION":
+                        self._timing("completed")
+                        if "text" not in result or result["text"] is None or result["text"] == '': raise UnknownValueError()
+                        return result["text"]
+                complete = True
+            except urllib3.exceptions.NewConnectionError as e:  # subclass of ConnectTimeoutError, but not a timeout
+                raise RequestError("recognition connection failed: {}".format(e))
+            except urllib3.exceptions.TimeoutError as e:
+                raise self._timeout_error(deadline, "recognition request timed out: {}".format(e))
+            except urllib3.exceptions.HTTPError as e:
+                raise RequestError("recognition connection failed: {}".format(e))
+            except ValueError as e:
+                raise RequestError("recognition response malformed: {}".format(e))
+            finally:
+                if response is not None:
+                    if complete: response.release_conn()  # back to the pool, the next request skips the handshake
+                    else: response.close()  # unread data left, the connection can't be reused
+            self._timing("completed")
             
             # return results
             if show_all: return results
-            for result in results:
-                if "code" in result and result["code"] == "bad-request": raise RequestError("recognition request failed")
-                if result["type"] == "FINAL_TRANSCRIPTION":
-                    if "text" not in result or result["text"] is None or result["text"] == '': raise UnknownValueError()
-                    return result["text"]
-
             return None     # If you reach here there are problem with the API response
 
+    async def recognize_wit_async(self, audio_data, key, show_all=False, encoding="wav", convert_rate=None, deadline=None):
+        """
+        Coroutine version of ``recognize_wit``, same arguments, results and exceptions, for callers running an asyncio event loop: the request doesn't block the loop and no thread is needed.
+
+        Requires `aiohttp <https://docs.aiohttp.org/>`__. The connections are pooled in a session bound to the running event loop, close it with ``await recognizer.aclose()`` before closing the loop. Cancelling the task aborts the request.
+        """
+        import aiohttp
+
+        assert isinstance(audio_data, AudioData), "Data must be audio data"
+        assert isinstance(key, str), "``key`` must be a string"
+
+        payload, content_type = self._wit_payload(audio_data, encoding, convert_rate)
+        self._timing("wav_encoded")
+        url = self.wit_api_url + "/speech?v=20210926"
+        session = self._aiohttp_session()
+        timeout = self._aiohttp_timeout(deadline)
+        self._timing("request_sent")
+        try:
+            async with session.post(url, data=payload, headers={"Authorization": "Bearer {}".format(key), "Content-Type": content_type}, timeout=timeout) as response:
+                self._timing("first_byte")
+                if response.status >= 400: raise RequestError("recognition request failed: HTTP {} {}".format(response.status, response.reason))
+                response_text = (await response.read()).decode("utf-8")
+        except asyncio.TimeoutError:
+            raise self._timeout_error(deadline, "recognition request timed out")
+        except aiohttp.ClientError as e:
+            raise RequestError("recognition connection failed: {}".format(e))
+        self._timing("completed")
+        result = json.loads(response_text)
+
+        # return results
+        if show_all: return result
+        if "text" not in result or result["text"] is None: raise UnknownValueError()
+        return result["text"]
+
+    async def recognize_wit_new_async(self, audio_data, key, show_all=False, api="dictation", deadline=None):
+        """
+        Coroutine version of ``recognize_wit_new``, same arguments, results and exceptions. The streamed response is decoded while it arrives and the final transcription is returned as soon as it is received.
+
+        Requires `aiohttp <https://docs.aiohttp.org/>`__, see ``recognize_wit_async``.
+        """
+        import aiohttp
+
+        assert isinstance(audio_data, AudioData), "Data must be audio data"
+        assert isinstance(key, str), "``key`` must be a string"
+        assert isinstance(api, str), "``api`` must be a string"
+
+        wav_data = audio_data.get_wav_data(
+            convert_rate=None if audio_data.sample_rate >= 8000 else 8000,  # audio samples must be at least 8 kHz
+            convert_width=2  # audio samples should be 16-bit
+        )
+        self._timing("wav_encoded")
+        url = self.wit_api_url + "/" + api
+        session = self._aiohttp_session()
+        timeout = self._aiohttp_timeout(deadline)
+        decoder = JsonStreamDecoder()
+        results = []
+        self._timing("request_sent")
+        try:
+            async with session.post(url, data=wav_data, headers={"Authorization": "Bearer {}".format(key), "Content-Type": "audio/wav"}, timeout=timeout) as response:
+                self._timing("first_byte")
+                if response.status >= 400: raise RequestError("recognition request failed: HTTP {} {}".format(response.status, response.reason))
+                async for chunk in response.content.iter_any():
+                    for result in decoder.feed(chunk):
+                        if show_all:
+                            results.append(result)
+                            continue
+                        if "code" in result and result["code"] == "bad-request": raise RequestError("recognition request failed")
+                        if result.get("type") == "FINAL_TRANSCRIPTION":
+                            self._timing("completed")
+                            if "text" not in result or result["text"] is None or result["text"] == '': raise UnknownValueError()
+                            return result["text"]
+                decoder.close()
+        except asyncio.TimeoutError:
+            raise self._timeout_error(deadline, "recognition request timed out")
+        except aiohttp.ClientError as e:
+            raise RequestError("recognition connection failed: {}".format(e))
+        except ValueError as e:
+            raise RequestError("recognition response malformed: {}".format(e))
+        self._timing("completed")
+
+        # return results
+        if show_all: return results
+        return None     # If you reach here there are problem with the API response
+
+    async def aclose(self):
+        """Closes the HTTP session of the ``*_async`` recognizers, call it before closing the event loop."""
+        if self._session is not None and not self._session.closed and self._session_loop is asyncio.get_running_loop():
+            await self._session.close()
+        self._session = None
+        self._session_loop = None
+
+    def _aiohttp_session(self):
+        import aiohttp
+
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._session_loop is not loop:
+            self._session = aiohttp.ClientSession()  # pooled keep-alive connections, one session per event loop
+            self._session_loop = loop
+        return self._session
+
+    def _aiohttp_timeout(self, deadline):
+        import aiohttp
+
+        connect_timeout, read_timeout = self._request_timeouts(deadline)
+        return aiohttp.ClientTimeout(total=read_timeout, sock_connect=connect_timeout)
+
+    def _wit_payload(self, audio_data, encoding, convert_rate):
+        if encoding == "wav" and convert_rate is None:
+            payload = audio_data.get_wav_data(
+                convert_rate=None if audio_data.sample_rate >= 8000 else 8000,  # audio samples must be at least 8 kHz
+                convert_width=2  # audio samples should be 16-bit
+            )
+            return payload, "audio/wav"
+        return encode_audio(audio_data, encoding, convert_rate)
+
+    def _timing(self, stage):
+        if self.timing_hook is not None: self.timing_hook(stage)
+
+    def _request_timeouts(self, deadline):
+        # (connect, read) timeouts from the remaining budget, capped by ``operation_timeout``
+        if deadline is None: return self.operation_timeout, self.operation_timeout
+        remaining = deadline - time.monotonic()
+        if remaining <= 0: raise DeadlineExceeded("deadline exceeded before the request was sent")
+        if self.operation_timeout is not None: remaining = min(remaining, self.operation_timeout)
+        return min(self.connect_timeout, remaining), remaining
+
+    def _timeout_error(self, deadline, message):
+        if deadline is not None and time.monotonic() >= deadline: return DeadlineExceeded(message)
+        return RequestError(message)
+
+    def recognize_hedged(self, audio_data, engine, deadline=None, name="default", hedge_quantile=0.9, min_samples=10, max_hedges=1):
+        """
+        Performs speech recognition on ``audio_data`` (an ``AudioData`` instance) with ``engine``, a callable taking the ``AudioData`` instance and a ``deadline`` keyword argument, for example ``lambda audio, deadline: r.recognize_wit(audio, key=KEY, deadline=deadline)``.
+
+        If the request takes longer than the ``hedge_quantile`` of the latencies observed for ``name`` (once ``min_samples`` are known), a duplicate request is sent, up to ``max_hedges`` times, and the first answer wins: one slow connection no longer delays the command. With ``hedge_quantile`` set to ``None`` no duplicate is sent.
+
+        The requests are abandoned when ``deadline`` (a ``time.monotonic()`` value) passes, raising a ``speech_recognition.DeadlineExceeded`` exception; the counters are in ``self.hedge_stats[name]``.
+
+        Raises the engine's exception (``UnknownValueError``, ``RequestError``) if every request failed.
+        """
+        assert isinstance(audio_data, AudioData), "Data must be audio data"
+
+        if self._race_executor is None:
+            self._race_executor = concurrent.futures.ThreadPoolExecutor(max_workers=8, thread_name_prefix="recognize_first")
+        latencies = self.hedge_latencies.setdefault(name, collections.deque(maxlen=200))
+        stats = self.hedge_stats.setdefault(name, {"requests": 0, "hedges": 0, "hedge_wins": 0, "abandoned": 0})
+        if deadline is not None and deadline <= time.monotonic():
+            stats["abandoned"] += 1
+            raise DeadlineExceeded("deadline exceeded before the request was sent")
+
+        hedge_after = None
+        if hedge_quantile is not None and len(latencies) >= min_samples:
+            ordered = sorted(latencies)
+            hedge_after = ordered[min(int(hedge_quantile * len(ordered)), len(ordered) - 1)]
+
+        def run():
+            start = time.monotonic()
+            result = engine(audio_data, deadline=deadline)
+            latencies.append(time.monotonic() - start)
+            return result
+
+        futures = [self._race_executor.submit(run)]
+        first = futures[0]
+        hedges = 0
+        stats["requests"] += 1
+        error = None
+        try:
+            while futures:
+                timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+                if hedge_after is not None and hedges < max_hedges:
+                    timeout = hedge_after if timeout is None else min(timeout, hedge_after)
+                done, _ = concurrent.futures.wait(futures, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+                if not done:
+                    if deadline is not None and time.monotonic() >= deadline:
+                        stats["abandoned"] += 1
+                        raise DeadlineExceeded("no answer before the deadline, request abandoned")
+                    futures.append(self._race_executor.submit(run))  # hedge: same request, first answer wins
+                    hedges += 1
+                    stats["hedges"] += 1
+                    continue
+                for future in done:
+                    hedged = future is not first
+                    futures.remove(future)
+                    try:
+                        result = future.result()
+                    except (UnknownValueError, RequestError) as e:
+                        error = e
+                        continue
+                    if hedged: stats["hedge_wins"] += 1
+                    return result
+        finally:
+            for future in futures: future.cancel()
+        raise error
+
+    def recognize_first(self, audio_data, engines, predicate=None, timeout=None):
+        """
+        Performs speech recognition on ``audio_data`` (an ``AudioData`` instance) with several engines at the same time, and returns the first usable result as a ``(engine_name, result)`` tuple.
+
+        ``engines`` is a dictionary mapping a name to a callable taking the ``AudioData`` instance, for example ``{"wit": lambda audio: r.recognize_wit(audio, key=KEY), "vosk": r.recognize_vosk}``. A result is usable if ``predicate(result)`` is true (any result if ``predicate`` is ``None``); the other engines are cancelled if they haven't started yet, or ignored. Sharing a ``NumpyAudioData`` instance lets the engines share the format conversions.
+
+        Per-engine runs, wins, errors and latency are accumulated in ``self.race_stats``, to tune the mix of engines.
+
+        Raises a ``speech_recognition.WaitTimeoutError`` exception if nothing usable arrives within ``timeout`` seconds. Raises a ``speech_recognition.UnknownValueError`` exception if no engine returns a usable result, or a ``speech_recognition.RequestError`` exception if all of them failed with a request error. Any other exception of an engine counts as that engine's error and the race goes on; it is raised again only if every engine failed.
+        """
+        assert isinstance(audio_data, AudioData), "Data must be audio data"
+        assert len(engines) > 0, "At least one engine is needed"
+
+        if self._race_executor is None:
+            self._race_executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(8, 2 * len(engines)), thread_name_prefix="recognize_first")
+
+        def run(name, engine):
+            start = time.monotonic()
+            try:
+                return engine(audio_data)
+            finally:
+                stats = self.race_stats[name]
+                stats["runs"] += 1
+                stats["latency"] += time.monotonic() - start
+
+        futures = {}
+        for name, engine in engines.items():
+            self.race_stats.setdefault(name, {"runs": 0, "wins": 0, "errors": 0, "latency": 0.0})
+            futures[self._race_executor.submit(run, name, engine)] = name
+
+        pending = set(futures)
+        request_errors = []
+        failures = []       # Other exceptions, the first one is raised if no engine survives
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            while pending:
+                remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+                done, pending = concurrent.futures.wait(pending, timeout=remaining, return_when=concurrent.futures.FIRST_COMPLETED)
+                if not done: raise WaitTimeoutError("no usable result from {} within {} seconds".format(", ".join(sorted(futures[f] for f in pending)), timeout))
+                for future in done:
+                    name = futures[future]
+                    try:
+                        result = future.result()
+                    except RequestError as e:
+                        self.race_stats[name]["errors"] += 1
+                        request_errors.append("{}: {}".format(name, e))
+                        continue
+                    except UnknownValueError:
+                        continue
+                    except Exception as e:
+                        self.race_stats[name]["errors"] += 1
+                        failures.append(e)
+                        continue
+                    if predicate is None or predicate(result):
+                        self.race_stats[name]["wins"] += 1
+                        return name, result
+        finally:
+            for future in pending: future.cancel()
+
+        if len(request_errors) == len(futures): raise RequestError("; ".join(request_errors))
+        if len(request_errors) + len(failures) == len(futures) and failures: raise failures[0]
+        raise UnknownValueError()
+
     def recognize_azure(self, audio_data, key, language="en-US", profanity="masked", location="westus", show_all=False):
         """
         Performs speech recognition on ``audio_data`` (an ``AudioData`` instance), using the Microsoft Azure Speech API.
@@ -1537,6 +1848,361 @@ class PortableNamedTemporaryFile(object):
         return self._file.flush(*args, **kwargs)
 
 
+# ===============================
+#  streaming JSON decoder
+# ===============================
+
+_JSON_STRUCTURE = re.compile(rb'[{}"\\]')
+
+
+class JsonStreamDecoder(object):
+    """
+    Incremental decoder for a stream of concatenated JSON objects, like the ones of the Wit.ai ``/dictation`` and ``/speech`` streaming APIs: ``feed`` it the chunks as they arrive, it returns the top-level objects completed by each chunk.
+
+    Each byte is scanned once, whatever the chunk boundaries: the scanner keeps its state (nesting depth, inside a string, escape) between chunks and only jumps between the structural characters.
+    """
+    def __init__(self):
+        self._buffer = bytearray()
+        self._depth = 0
+        self._in_string = False
+        self._start = 0
+        self._position = 0
+
+    def feed(self, chunk):
+        buffer = self._buffer
+        buffer += chunk
+        objects = []
+        while True:
+            match = _JSON_STRUCTURE.search(buffer, self._position)
+            if match is None:
+                self._position = len(buffer)
+                break
+            index = match.start()
+            char = buffer[index]
+            if self._in_string:
+                if char == 0x5C:  # backslash, skip the escaped character
+                    if index + 1 >= len(buffer):
+                        self._position = index  # wait for the next chunk
+                        break
+                    self._position = index + 2
+                    continue
+                if char == 0x22: self._in_string = False
+            elif char == 0x22:
+                self._in_string = True
+            elif char == 0x7B:
+                if self._depth == 0: self._start = index
+                self._depth += 1
+            elif char == 0x7D and self._depth > 0:
+                self._depth -= 1
+                if self._depth == 0:
+                    objects.append(json.loads(bytes(buffer[self._start:index + 1])))
+                    del buffer[:index + 1]
+                    self._position = 0
+                    continue
+            self._position = index + 1
+        if self._depth == 0 and not self._in_string:
+            del buffer[:self._position]  # only whitespace between the objects
+            self._position = 0
+        return objects
+
+    def close(self):
+        """Raises a ``ValueError`` if the stream ended inside an object."""
+        if self._depth > 0 or self._in_string: raise ValueError("JSON stream truncated inside an object")
+
+
+def iter_json_objects(chunks):
+    """
+    Yields every top-level JSON object found in ``chunks`` (an iterable of ``bytes``, for example an HTTP response read in pieces) as soon as its closing brace arrives. See ``JsonStreamDecoder``.
+
+    Raises a ``ValueError`` if the stream ends inside an object.
+    """
+    decoder = JsonStreamDecoder()
+    for chunk in chunks:
+        yield from decoder.feed(chunk)
+    decoder.close()
+
+
+# ===============================
+#  in-process payload encoders
+# ===============================
+
+def encode_audio(audio_data, encoding="raw", convert_rate=None):
+    """
+    Returns a ``(payload, content_type)`` tuple with the audio of ``audio_data`` (an ``AudioData`` instance) as 16-bit mono samples encoded according to ``encoding``:
+
+    * ``"wav"``: 16-bit WAV (``audio/wav``);
+    * ``"raw"``: headerless little-endian 16-bit PCM (``audio/raw``);
+    * ``"mulaw"``: 8-bit G.711 mu-law, half the bytes of ``"raw"`` (``audio/raw;encoding=mu-law``);
+    * ``"flac"``: lossless FLAC (``audio/x-flac``), encoded in-process without the ``flac`` command line tool.
+
+    If ``convert_rate`` is specified the audio is resampled first; an integer ratio (16 kHz to 8 kHz) goes through a low-pass FIR and a decimation, anything else through ``AudioData.get_raw_data``.
+
+    Everything is vectorised with NumPy, no subprocess is started.
+    """
+    assert isinstance(audio_data, AudioData), "Data must be audio data"
+    if isinstance(audio_data, NumpyAudioData):
+        return audio_data._memo(("encode", encoding, convert_rate), lambda: _encode_audio(audio_data, encoding, convert_rate))
+    return _encode_audio(audio_data, encoding, convert_rate)
+
+
+def _encode_audio(audio_data, encoding, convert_rate):
+    import numpy as np
+
+    rate = audio_data.sample_rate
+    if convert_rate is not None and convert_rate != rate and rate % convert_rate == 0:
+        samples = _decimate(np.frombuffer(audio_data.get_raw_data(convert_width=2), "<i2"), rate // convert_rate)
+        rate = convert_rate
+    else:
+        samples = np.frombuffer(audio_data.get_raw_data(convert_rate=convert_rate, convert_width=2), "<i2")
+        rate = convert_rate or rate
+
+    if encoding == "raw":
+        return samples.tobytes(), "audio/raw;encoding=signed-integer;bits=16;rate={};endian=little".format(rate)
+    if encoding == "mulaw":
+        return _mulaw(samples).tobytes(), "audio/raw;encoding=mu-law;bits=8;rate={};endian=big".format(rate)
+    if encoding == "flac":
+        return _flac(samples, rate), "audio/x-flac"
+    if encoding == "wav":
+        with io.BytesIO() as wav_file:
+            with wave.open(wav_file, "wb") as wav_writer:
+                wav_writer.setframerate(rate)
+                wav_writer.setsampwidth(2)
+                wav_writer.setnchannels(1)
+                wav_writer.writeframes(samples.tobytes())
+            return wav_file.getvalue(), "audio/wav"
+    raise ValueError("unknown encoding: {}".format(encoding))
+
+
+_fir_cache = {}
+
+
+def _decimate(samples, factor, taps=31):
+    import numpy as np
+
+    h = _fir_cache.get((factor, taps))
+    if h is None:
+        # windowed sinc, cutoff a bit below the new Nyquist frequency
+        n = np.arange(taps) - (taps - 1) / 2
+        cutoff = 0.45 / factor
+        h = 2 * cutoff * np.sinc(2 * cutoff * n) * np.hamming(taps)
+        h = _fir_cache[(factor, taps)] = (h / h.sum()).astype(np.float32)
+    filtered = np.convolve(samples.astype(np.float32), h, mode="same")[::factor]
+    return np.clip(np.rint(filtered), -32768, 32767).astype("<i2")
+
+
+def _mulaw(samples):
+    # G.711 mu-law on 14-bit magnitudes, same output as ``audioop.lin2ulaw(data, 2)``
+    import numpy as np
+
+    x = samples.astype(np.int32) >> 2
+    mask = np.where(x < 0, 0x7F, 0xFF)
+    magnitude = np.minimum(np.abs(x), 8159) + 33
+    segment = np.clip(np.floor(np.log2(magnitude)).astype(np.int32) - 5, 0, 8)
+    code = np.where(segment >= 8, 0x7F, (np.minimum(segment, 7) << 4) | ((magnitude >> (np.minimum(segment, 7) + 1)) & 0x0F))
+    return (code ^ mask).astype(np.uint8)
+
+
+def _crc_table(poly, width):
+    table = []
+    top = 1 << (width - 1)
+    mask = (1 << width) - 1
+    for byte in range(256):
+        crc = byte << (width - 8)
+        for _ in range(8):
+            crc = ((crc << 1) ^ poly) if crc & top else (crc << 1)
+        table.append(crc & mask)
+    return table
+
+
+_CRC8 = _crc_table(0x07, 8)
+_CRC16 = _crc_table(0x8005, 16)
+
+
+def _crc8(data):
+    crc = 0
+    for byte in data:
+        crc = _CRC8[crc ^ byte]
+    return crc
+
+
+_CRC16_CHUNK = 16
+_crc16_shifts = {}  # bytes of zeros appended -> (table of the high byte, table of the low byte) of the shifted CRC
+
+
+def _crc16_shift(span):
+    # CRC-16 has no init or final xor, so it is linear: crc(a + b) == shift(crc(a), len(b)) ^ crc(b), where shift()
+    # appends ``span`` zero bytes. Tables for a span are built from the half span, down to the chunk length.
+    import numpy as np
+
+    if span not in _crc16_shifts:
+        if span == _CRC16_CHUNK:
+            table = np.array(_CRC16, np.uint16)
+            crc = np.concatenate([np.arange(256, dtype=np.uint16) << 8, np.arange(256, dtype=np.uint16)])
+            for _ in range(span):
+                crc = (crc << 8) ^ table[crc >> 8]
+        else:
+            high, low = _crc16_shift(span // 2)
+            crc = np.concatenate([high, low])
+            crc = high[crc >> 8] ^ low[crc & 0xFF]
+        _crc16_shifts[span] = (crc[:256], crc[256:])
+    return _crc16_shifts[span]
+
+
+def _crc16(data):
+    # The chunks of the frame in parallel, then merged pairwise: a few dozen NumPy operations instead of a Python
+    # step per byte. Leading zero bytes don't change the CRC, so the data is padded at the front.
+    import numpy as np
+
+    data = np.frombuffer(data, np.uint8)
+    chunks = -(-data.size // _CRC16_CHUNK)
+    chunks = 1 << max(chunks - 1, 0).bit_length()
+    padded = np.zeros(chunks * _CRC16_CHUNK, np.uint8)
+    padded[padded.size - data.size:] = data
+    padded = padded.reshape(chunks, _CRC16_CHUNK)
+
+    table = np.array(_CRC16, np.uint16)
+    crc = np.zeros(chunks, np.uint16)
+    for column in range(_CRC16_CHUNK):
+        crc = (crc << 8) ^ table[(crc >> 8) ^ padded[:, column]]
+    span = _CRC16_CHUNK
+    while crc.size > 1:
+        high, low = _crc16_shift(span)
+        left = crc[0::2]
+        crc = high[left >> 8] ^ low[left & 0xFF] ^ crc[1::2]
+        span *= 2
+    return int(crc[0])
+
+
+def _bits(fields):
+    # ``fields`` is a list of (value, number of bits), MSB first
+    import numpy as np
+
+    return np.concatenate([(np.uint64(value) >> np.arange(n - 1, -1, -1, dtype=np.uint64)) & np.uint64(1) for value, n in fields]).astype(np.uint8)
+
+
+def _rice(residual, k):
+    # Rice codes of the residuals as a bit array: zigzag, unary quotient terminated by a 1, k bits of remainder
+    import numpy as np
+
+    u = np.where(residual >= 0, residual << 1, ((-residual) << 1) - 1).astype(np.int64)
+    q = u >> k
+    lengths = q + 1 + k
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    out = np.zeros(int(lengths.sum()), np.uint8)
+    out[starts + q] = 1
+    if k:
+        shifts = np.arange(k - 1, -1, -1)
+        out[(starts + q + 1)[:, None] + np.arange(k)] = (u[:, None] >> shifts) & 1
+    return out
+
+
+def _subframe(block):
+    # Best fixed predictor (order 0 to 4, the residual is the n-th difference) with a single Rice partition,
+    # or verbatim if nothing is smaller
+    import numpy as np
+
+    best = None
+    x = block.astype(np.int64)
+    for order in range(min(4, x.size - 1) + 1):
+        residual = np.diff(x, order) if order else x
+        u = np.where(residual >= 0, residual << 1, ((-residual) << 1) - 1)
+        costs = [int((u >> k).sum()) + residual.size * (k + 1) for k in range(15)]
+        k = int(np.argmin(costs))
+        size = 8 + 16 * order + 6 + 4 + costs[k]
+        if best is None or size < best[0]:
+            best = (size, order, k, residual)
+
+    size, order, k, residual = best
+    if size >= 8 + 16 * x.size:
+        return np.concatenate((_bits([(0b00000010, 8)]), _bits([(int(v) & 0xFFFF, 16) for v in x])))
+    header = [(0b00010000 | (order << 1), 8)] + [(int(v) & 0xFFFF, 16) for v in x[:order]] + [(0, 2), (0, 4), (k, 4)]
+    return np.concatenate((_bits(header), _rice(residual, k)))
+
+
+def _utf8_number(n):
+    # FLAC frame numbers use the UTF-8 encoding scheme (extended to 36 bits)
+    if n < 0x80:
+        return bytes([n])
+    for length in range(2, 8):
+        if n < (1 << (5 * length + 1)):
+            break
+    out = []
+    for _ in range(length - 1):
+        out.append(0x80 | (n & 0x3F))
+        n >>= 6
+    out.append(((0xFF00 >> length) & 0xFF) | n)
+    return bytes(reversed(out))
+
+
+def _flac(samples, rate, blocksize=4096):
+    import numpy as np
+
+    total = samples.size
+    streaminfo = _bits([(blocksize, 16), (blocksize, 16), (0, 24), (0, 24), (rate, 20), (0, 3), (15, 5), (total, 36)])
+    header = b"fLaC" + bytes([0x80, 0, 0, 34]) + np.packbits(streaminfo).tobytes() + hashlib.md5(samples.astype("<i2").tobytes()).digest()
+
+    frames = [header]
+    for number, start in enumerate(range(0, total, blocksize)):
+        block = samples[start:start + blocksize]
+        # sync, fixed blocking, 16-bit block size at the end of the header, rate from STREAMINFO, mono, 16 bits per sample
+        frame = np.packbits(_bits([(0b11111111111110, 14), (0, 2), (0b0111, 4), (0, 4), (0, 4), (0b100, 3), (0, 1)])).tobytes()
+        frame += _utf8_number(number) + (block.size - 1).to_bytes(2, "big")
+        frame += bytes([_crc8(frame)])
+        frame += np.packbits(_subframe(block)).tobytes()    # zero padded to the byte boundary
+        frames.append(frame + _crc16(frame).to_bytes(2, "big"))
+    return b"".join(frames)
+
+
+
+class NumpyAudioData(AudioData):
+    """
+    ``AudioData`` backed by a NumPy array (or anything with the buffer protocol) of samples, without copying it.
+
+    Every derived representation (raw data at a given rate and width, WAV, AIFF, FLAC, the payloads of ``encode_audio``) is computed on first use and kept in a small LRU cache of ``cache_size`` entries, so several engines recognizing the same audio share the conversions instead of repeating them.
+
+    The buffer must not be modified while the instance is in use.
+    """
+    def __init__(self, samples, sample_rate, sample_width=None, cache_size=8):
+        view = memoryview(samples)
+        assert view.c_contiguous, "Samples must be contiguous"
+        if sample_width is None: sample_width = view.itemsize
+        super().__init__(view.cast("B"), sample_rate, sample_width)
+        self.samples = samples
+        self.cache_size = cache_size
+        self._cache = collections.OrderedDict()
+        self._cache_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _memo(self, key, compute):
+        with self._cache_lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return self._cache[key]
+            self.misses += 1
+        value = compute()  # outside the lock, engines running in parallel don't wait on each other
+        with self._cache_lock:
+            self._cache[key] = value
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return value
+
+    def get_raw_data(self, convert_rate=None, convert_width=None):
+        if convert_rate in (None, self.sample_rate) and convert_width in (None, self.sample_width):
+            return self._memo(("raw", None, None), lambda: bytes(self.frame_data))  # a byte string as documented (C bindings like vosk reject a memoryview), copied once per clip
+        return self._memo(("raw", convert_rate, convert_width), lambda: super(NumpyAudioData, self).get_raw_data(convert_rate, convert_width))
+
+    def get_wav_data(self, convert_rate=None, convert_width=None):
+        return self._memo(("wav", convert_rate, convert_width), lambda: super(NumpyAudioData, self).get_wav_data(convert_rate, convert_width))
+
+    def get_aiff_data(self, convert_rate=None, convert_width=None):
+        return self._memo(("aiff", convert_rate, convert_width), lambda: super(NumpyAudioData, self).get_aiff_data(convert_rate, convert_width))
+
+    def get_flac_data(self, convert_rate=None, convert_width=None):
+        return self._memo(("flac", convert_rate, convert_width), lambda: super(NumpyAudioData, self).get_flac_data(convert_rate, convert_width))
+
+
 # During the pip install process, the 'import speech_recognition' command in setup.py is executed.
 # At this time, the dependencies are not yet installed, resulting in a ModuleNotFoundError.
 # This is a workaround to resolve this issue
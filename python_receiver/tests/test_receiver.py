@@ -0,0 +1,85 @@
+'''
+    Tests of the receiver logic, run with "python -m pytest python_receiver/tests" (needs the packages of recognizer.py)
+'''
+
+import asyncio
+import os
+import sys
+
+import numpy as np
+import pytest
+
+for module in ("serial", "serial_asyncio_fast", "speech_recognition", "paho.mqtt.client"):
+    pytest.importorskip(module)
+if os.name == "posix":
+    pytest.importorskip("uvloop")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import recognizer as R
+
+
+def test_steady_fall_behind_is_an_overrun_not_a_loss():
+    # The host reads a 512 samples block every 32.64 ms instead of 32 ms, 2% too slow, for a minute
+    accounting = R.StreamAccounting(16000, 512)
+    now = 100.0
+    for _ in range(1800):
+        accounting.block(512, now)
+        now += 512 / 16000 * 1.02
+    assert accounting.overruns > 0
+    assert accounting.lost_samples == 0
+
+
+def test_step_of_the_floor_is_a_loss():
+    # On time, then 2000 samples (125 ms) never arrive
+    accounting = R.StreamAccounting(16000, 512)
+    now = 100.0
+    for k in range(1000):
+        accounting.block(512, now)
+        now += 512 / 16000
+        if k == 400:
+            now += 2000 / 16000
+    assert accounting.losses == 1
+    assert abs(accounting.lost_samples - 2000) < 100
+    assert accounting.overruns == 0
+
+
+def capture(tmp_path, monkeypatch, policy, gap):
+    # Noise with two loud bursts <gap> seconds apart, replayed through receiver(), returns the queued utterances
+    rng = np.random.default_rng(1)
+    samples = rng.normal(0, 200, 9 * 16000)
+    burst = 20000 * np.sin(2 * np.pi * 440 * np.arange(int(0.3 * 16000)) / 16000)
+    for start in (2.0, 2.0 + gap):
+        samples[int(start * 16000): int(start * 16000) + burst.size] = burst
+    path = str(tmp_path / "two_triggers.bin")
+    samples.astype(np.int16).tofile(path)
+
+    monkeypatch.setattr(R, "overload_policy", policy)
+    monkeypatch.setattr(R, "admission", False)      # Only the capture decides here
+    monkeypatch.setattr(R, "replay_speed", 0)
+    monkeypatch.setattr(R, "audio_queue", R.UtteranceQueue(4, R.clip_length(), policy=policy))
+    R.event.set()
+    R.stop.clear()
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        await R.receiver(loop, R.Device(0, "test", path), path, asyncio.Event())
+    asyncio.run(run())
+
+    utterances = []
+    while True:
+        utt = R.audio_queue.get_nowait()
+        if utt is None:
+            return utterances
+        utterances.append(utt)
+
+
+def test_adjacent_triggers_are_coalesced(tmp_path, monkeypatch):
+    # The second burst comes 0.5 s after the first capture ended, inside the hold-off
+    utterances = capture(tmp_path, monkeypatch, "coalesce", 2.0)
+    assert len(utterances) == 1
+    assert utterances[0].samples.size / 16000 > 1 + 2.0 + 1.5 - 0.1     # Pre-roll, both bursts and the capture after the second
+
+
+def test_adjacent_triggers_without_coalesce(tmp_path, monkeypatch):
+    utterances = capture(tmp_path, monkeypatch, "drop-oldest", 2.0)
+    assert len(utterances) == 2